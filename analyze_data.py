@@ -7,6 +7,10 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import matplotlib.dates as mdates
 
+from data_cache import load_formatted
+from flow_analysis import get_volume_diff
+from resampler import resample_frame
+
 
 def head2bar(head):
     return head * 0.09804
@@ -20,40 +24,28 @@ def get_interpolated_pressure(source):
     """
     Get resampled values of pressure
     """
-    df = pd.read_csv(
-        source, delimiter=";", parse_dates=["Time"], index_col="Time"
-    )
-    pressure_upsample = df["Press Inst [bar]"].resample("1T").mean()
-    pressure_interpolate = pressure_upsample.interpolate()
-    pressure_downsample = pressure_interpolate.resample("10T").mean()
-    return pressure_downsample
+    df = load_formatted(source)
+    return resample_frame(df, ["Press Inst [bar]"])["Press Inst [bar]"]
 
 
 def get_interpolated_flow(source):
     """
     Get resampled values of flow
     """
-    df = pd.read_csv(
-        source, delimiter=";", parse_dates=["Time"], index_col="Time"
-    )
-    flow_upsample = df["Flow 1 [m^3]"].resample("1T").mean()
-    flow_interpolate = flow_upsample.interpolate()
-    flow_downsample = flow_interpolate.resample("10T").mean()
-    return flow_downsample
+    df = load_formatted(source)
+    return resample_frame(df, ["Flow 1 [m^3]"])["Flow 1 [m^3]"]
 
 
-def get_flow_rate(df):
+def get_flow_rate(df, rollover=None):
     """
     Get the average flow for a time range, based on measured volume.
+
+    See flow_analysis.get_flow_rate for rates over the actual time between
+    samples.
     """
-    flow_rate_frame = pd.DataFrame.copy(df)
+    # Convert from m^3 to L with 1000. Should be divided by 600 for 10 minutes
+    flow_rate_frame = 120 * (1000 / 600) * get_volume_diff(df, rollover)
     flow_rate_frame.iloc[0] = 0
-    for i in range(1, len(df)):
-        # Convert from m^3 to L with 1000. Should be divided by 600 for 10 minutes
-        flow_rate_frame.iloc[i] = (
-            120 * (1000 / 600) * df.iloc[i]
-            - 120 * (1000 / 600) * df.iloc[i - 1]
-        )
     return flow_rate_frame
 
 
@@ -102,9 +94,7 @@ def main():
     data_file = source_location + "2021-03-02-formatted.csv"
 
     # Load dataframes
-    df = pd.read_csv(
-        data_file, delimiter=";", parse_dates=["Time"], index_col="Time"
-    )
+    df = load_formatted(data_file)
     df_press = pd.DataFrame(df, columns=["Press Inst [bar]"])
     df_flow = pd.DataFrame(df, columns=["Flow 1 [m^3]"])
     df_diff = pd.DataFrame(df, columns=["Diff 1 [L]"])
@@ -116,9 +106,10 @@ def main():
         columns={"Diff 1 [L]": "Measured Volume [L]"}
     ).dropna()
 
-    # Process dataframes
-    df_press_i = get_interpolated_pressure(data_file)
-    df_flow_i = get_interpolated_flow(data_file)
+    # Process dataframes, pressure and flow are resampled together
+    df_i = resample_frame(df, ["Press Inst [bar]", "Flow 1 [m^3]"])
+    df_press_i = df_i["Press Inst [bar]"]
+    df_flow_i = df_i["Flow 1 [m^3]"]
     df_flow_rate = get_flow_rate(df_flow_i)
 
     # Save pressure and flow rate
@@ -0,0 +1,677 @@
+"""
+Benchmarks for the serial logger
+
+To run the frame reader benchmark:
+$ python benchmark.py frame-reader
+
+To measure how reading several ports in one process scales:
+$ python benchmark.py multi-port
+
+To compare the flow rate loop with the vectorized version:
+$ python benchmark.py flow-rate
+
+To run the benchmark suite and compare two runs:
+$ python benchmark.py suite -o before.json
+$ python benchmark.py suite -o after.json
+$ python benchmark.py compare before.json after.json
+
+To measure how long each command of the logger takes to start:
+$ python benchmark.py startup
+"""
+
+import click
+import itertools
+import json
+import os
+import platform
+import random
+import serial
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+from frame_reader import FrameReader
+from mbus_decoder import format_frame
+from pipeline import Stage
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+
+###############################################################################
+# Main function
+###############################################################################
+@click.group()
+def main():
+    """
+    Benchmarks for the serial logger
+    """
+    pass
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+def open_fake_port():
+    """
+    Open a pty pair and return the master fd and a serial port on the slave
+    """
+    master_fd, slave_fd = os.openpty()
+    ser = serial.Serial(os.ttyname(slave_fd), 19200)
+    return master_fd, slave_fd, ser
+
+
+def close_fake_port(master_fd, slave_fd, ser):
+    """
+    Close a pty pair opened with open_fake_port
+    """
+    ser.close()
+    os.close(slave_fd)
+    os.close(master_fd)
+
+
+def make_frames(count, seed=0):
+    """
+    Make frames with random content and a valid header
+    """
+    rng = random.Random(seed)
+    frames = []
+    for _ in range(count):
+        length = rng.randint(30, 47)
+        frames.append(
+            bytes([length, 0x44, 0x2D, 0x2C])
+            + bytes(rng.randrange(256) for _ in range(length - 3))
+        )
+    return frames
+
+
+def feed_port(master_fd, frames):
+    """
+    Write frames to the master side of a pty
+    """
+    data = b"".join(frames)
+    view = memoryview(data)
+    while view:
+        written = os.write(master_fd, view[:1024])
+        view = view[written:]
+
+
+def read_packet_per_byte(ser):
+    """
+    Read a packet one byte at a time, the way log_port used to
+    """
+    ser_byte = ser.read()
+    in_hex = ser_byte.hex()
+    packet = in_hex
+    for i in range(int(in_hex, 16)):
+        ser_byte = ser.read()
+        in_hex = ser_byte.hex()
+        packet += ";" + in_hex
+    return packet
+
+
+def time_reader(frames, read_all):
+    """
+    Time how long read_all takes to read frames fed through a fake port
+    """
+    master_fd, slave_fd, ser = open_fake_port()
+    try:
+        feeder = threading.Thread(
+            target=feed_port, args=(master_fd, frames), daemon=True
+        )
+        start = time.perf_counter()
+        feeder.start()
+        read_all(ser, len(frames))
+        elapsed = time.perf_counter() - start
+        feeder.join()
+    finally:
+        close_fake_port(master_fd, slave_fd, ser)
+    return elapsed
+
+
+def read_all_per_byte(ser, count):
+    for _ in range(count):
+        read_packet_per_byte(ser)
+
+
+def read_all_bulk(ser, count):
+    reader = FrameReader(ser)
+    while count > 0:
+        count -= len(reader.read_frames())
+
+
+@main.command()
+@click.option("-n", "--frames", type=int, default=20000)
+def frame_reader(frames):
+    """
+    Compare per-byte reads with the bulk frame reader on a pty
+    """
+    frame_list = make_frames(frames)
+    total_bytes = sum(len(frame) for frame in frame_list)
+    for name, read_all in (
+        ("per-byte", read_all_per_byte),
+        ("bulk", read_all_bulk),
+    ):
+        elapsed = time_reader(frame_list, read_all)
+        click.echo(
+            "%-10s %8.0f frames/s %10.0f bytes/s"
+            % (name, frames / elapsed, total_bytes / elapsed)
+        )
+
+
+def read_all_into(reader, count, output):
+    """
+    Read count frames and put them in the output stage, like
+    serial_logger.read_port
+    """
+    while count > 0:
+        frames = reader.read_frames()
+        count -= len(frames)
+        for frame in frames:
+            output.put((frame, 0, "2021-01-01"))
+
+
+def time_ports(ports, frames):
+    """
+    Time how long it takes to read and format frames fed through a number
+    of fake ports at once, all into one shared format stage
+    """
+    fake_ports = [open_fake_port() for _ in range(ports)]
+    format_stage = Stage(
+        "format", lambda item: format_frame(item[0], item[1]), 10000
+    )
+    format_stage.start()
+    try:
+        threads = []
+        for master_fd, _, ser in fake_ports:
+            threads.append(
+                threading.Thread(
+                    target=feed_port, args=(master_fd, frames), daemon=True
+                )
+            )
+            threads.append(
+                threading.Thread(
+                    target=read_all_into,
+                    args=(FrameReader(ser), len(frames), format_stage),
+                    daemon=True,
+                )
+            )
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        format_stage.stop()
+        elapsed = time.perf_counter() - start
+    finally:
+        for fake_port in fake_ports:
+            close_fake_port(*fake_port)
+    return elapsed
+
+
+@main.command()
+@click.option("-n", "--frames", type=int, default=20000, help="Per port")
+@click.option("-p", "--ports", "port_counts", default="1,2,4,8")
+def multi_port(frames, port_counts):
+    """
+    Read and format frames from several ptys in one process
+    """
+    frame_list = make_frames(frames)
+    for ports in [int(count) for count in port_counts.split(",")]:
+        elapsed = time_ports(ports, frame_list)
+        click.echo(
+            "%2d ports %8.0f frames/s %8.0f frames/s per port"
+            % (ports, ports * frames / elapsed, frames / elapsed)
+        )
+
+
+def make_volume_series(days, meters, seed=0):
+    """
+    Make cumulative volumes [m^3] every 10 minutes for a number of meters
+    """
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    index = pd.date_range("2021-01-01", periods=days * 144, freq="10min")
+    usage = rng.gamma(2.0, 0.01, size=(len(index), meters))
+    return pd.DataFrame(
+        usage.cumsum(axis=0),
+        index=index,
+        columns=["Flow %d [m^3]" % (i + 1) for i in range(meters)],
+    )
+
+
+def get_flow_rate_loop(df):
+    """
+    Get the flow rate with a loop over the rows, the way analyze_data used to
+    """
+    import pandas as pd
+
+    flow_rate_frame = pd.DataFrame.copy(df)
+    flow_rate_frame.iloc[0] = 0
+    for i in range(1, len(df)):
+        flow_rate_frame.iloc[i] = (
+            120 * (1000 / 600) * df.iloc[i]
+            - 120 * (1000 / 600) * df.iloc[i - 1]
+        )
+    return flow_rate_frame
+
+
+@main.command()
+@click.option("-d", "--days", type=int, default=365)
+@click.option("-m", "--meters", type=int, default=2)
+def flow_rate(days, meters):
+    """
+    Compare the flow rate loop with the vectorized flow rate on a synthetic
+    series of 10-minute volumes
+    """
+    import numpy as np
+
+    from flow_analysis import (
+        get_demand_pattern,
+        get_flow_rate,
+        get_interval_flow_rate,
+        get_volume_diff,
+    )
+
+    volumes = make_volume_series(days, meters)
+
+    start = time.perf_counter()
+    loop_result = get_flow_rate_loop(volumes)
+    loop_elapsed = time.perf_counter() - start
+
+    # Same as analyze_data.get_flow_rate, which needs matplotlib to import
+    start = time.perf_counter()
+    vectorized_result = 120 * (1000 / 600) * get_volume_diff(volumes)
+    vectorized_result.iloc[0] = 0
+    vectorized_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    get_flow_rate(volumes, max_gap="30min")
+    per_second_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    get_demand_pattern(get_interval_flow_rate(volumes))
+    pattern_elapsed = time.perf_counter() - start
+
+    click.echo("%d samples x %d meters" % (len(volumes), meters))
+    click.echo("%-12s %10.4f s" % ("loop", loop_elapsed))
+    click.echo("%-12s %10.4f s" % ("vectorized", vectorized_elapsed))
+    click.echo("%-12s %10.4f s" % ("L/s", per_second_elapsed))
+    click.echo("%-12s %10.4f s" % ("pattern", pattern_elapsed))
+    click.echo(
+        "max difference %g"
+        % np.abs(loop_result.to_numpy() - vectorized_result.to_numpy()).max()
+    )
+
+
+###############################################################################
+# Benchmark suite
+###############################################################################
+
+
+class MQTTStandIn:
+    """
+    Stand-in for AWSIoTMQTTClient that writes every message to a local
+    socket and records when it was published
+    """
+
+    def __init__(self):
+        self.publish_times = []
+        self._socket, self._peer = socket.socketpair()
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def publish(self, topic, payload, qos):
+        message = (topic + "\n" + payload).encode()
+        self._socket.sendall(len(message).to_bytes(4, "little") + message)
+        self.publish_times.append(time.perf_counter())
+        return True
+
+    def close(self):
+        self._socket.close()
+        self._thread.join()
+        self._peer.close()
+
+    def _drain(self):
+        while self._peer.recv(65536):
+            pass
+
+
+def time_micro(function, number):
+    """
+    Get the best time of one call to function, in seconds
+    """
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+
+def run_micro(frames):
+    """
+    Time decoding, serializing and writing of single packets
+    """
+    import serial_logger
+    from columnar_store import pack_record
+    from file_sinks import SinkManager
+    from frame_dedup import DuplicateFilter
+    from frame_reader import get_device_name, hex_packet
+    from mbus_decoder import (
+        calculate_pressure,
+        calculate_volume,
+        format_packet,
+    )
+    from mbus_formatter import save_packets
+    from rollups import RollupAggregator
+
+    frame_cycle = iter(frames * 1000)
+    raw_packets = ["100;" + hex_packet(frame) for frame in frames]
+    packets = [
+        serial_logger.process_frame((frame, 100, "2021-05-30"), 0, 1, 0)
+        for frame in frames
+    ]
+    flow_packet = next(p for p in packets if p.profile.sensor_type == "flow")
+    pressure_packet = next(
+        p for p in packets if p.profile.sensor_type == "pressure"
+    )
+    results = {}
+    results["format_frame"] = time_micro(
+        lambda: format_frame(next(frame_cycle), 100), 10000
+    )
+    results["format_packet"] = time_micro(
+        lambda: format_packet(raw_packets[0]), 10000
+    )
+    results["calculate_pressure"] = time_micro(
+        lambda: calculate_pressure(0x69, 1234), 100000
+    )
+    results["calculate_volume"] = time_micro(
+        lambda: calculate_volume(0x13, 123456789), 100000
+    )
+    results["get_device_name"] = time_micro(
+        lambda: get_device_name(frames[0]), 100000
+    )
+    results["hex_packet"] = time_micro(lambda: hex_packet(frames[0]), 100000)
+    duplicates = DuplicateFilter()
+    dedup_cycle = itertools.cycle(frames)
+    results["is_duplicate"] = time_micro(
+        lambda: duplicates.is_duplicate(next(dedup_cycle)), 100000
+    )
+    results["upload_payload_flow"] = time_micro(
+        lambda: json.dumps(serial_logger.build_upload_data(flow_packet)[1]),
+        10000,
+    )
+    results["upload_payload_pressure"] = time_micro(
+        lambda: json.dumps(
+            serial_logger.build_upload_data(pressure_packet)[1]
+        ),
+        10000,
+    )
+    rollups = RollupAggregator()
+    epochs = itertools.count(1622332800)
+    results["rollup_update"] = time_micro(
+        lambda: rollups.update(
+            flow_packet.device_name,
+            "flow",
+            next(epochs),
+            flow_packet.formatted_packet,
+        ),
+        10000,
+    )
+    results["pack_record"] = time_micro(
+        lambda: pack_record("flow", 0, flow_packet.formatted_packet), 10000
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        sinks = SinkManager()
+        path = os.path.join(directory, "sink.csv")
+        results["sink_write"] = time_micro(
+            lambda: sinks.write(path, raw_packets[0], "2021-05-30"), 10000
+        )
+        sinks.close()
+        path = os.path.join(directory, "save_packets.csv")
+        results["save_packets"] = time_micro(
+            lambda: save_packets(path, raw_packets[:1]), 1000
+        )
+    return {
+        name: {"us_per_op": 1e6 * seconds, "ops_per_s": 1 / seconds}
+        for name, seconds in results.items()
+    }
+
+
+def run_end_to_end(frames, rate):
+    """
+    Feed frames through a pty into the format, store and upload stages of
+    log_port, with uploads going to an MQTT stand-in
+
+    Frames are sent at rate frames per second, or as fast as the pty takes
+    them if rate is 0. The latency of a frame is the time from writing it
+    to the pty until it is published.
+    """
+    from file_sinks import SinkManager
+    from serial_logger import process_frame, store_packet, upload_packet
+
+    client = MQTTStandIn()
+    sinks = SinkManager()
+    format_stage = Stage(
+        "format", lambda item: process_frame(item, False, True, False)
+    )
+    store_stage = format_stage.connect(
+        Stage(
+            "store",
+            lambda packet: store_packet(sinks, packet, True, True, False),
+            idle_handler=sinks.flush_if_due,
+        )
+    )
+    upload_stage = format_stage.connect(
+        Stage("upload", lambda packet: upload_packet(client, packet))
+    )
+    stages = [format_stage, store_stage, upload_stage]
+
+    send_times = []
+    interval = 1.0 / rate if rate > 0 else 0.0
+
+    def feed(master_fd):
+        start = time.perf_counter()
+        for i, frame in enumerate(frames):
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            send_times.append(time.perf_counter())
+            view = memoryview(frame)
+            while view:
+                view = view[os.write(master_fd, view) :]
+
+    cwd = os.getcwd()
+    master_fd, slave_fd, ser = open_fake_port()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            for stage in stages:
+                stage.start()
+            reader = threading.Thread(
+                target=read_all_into,
+                args=(FrameReader(ser), len(frames), format_stage),
+            )
+            reader.start()
+            feeder = threading.Thread(target=feed, args=(master_fd,))
+            start = time.perf_counter()
+            feeder.start()
+            feeder.join()
+            while len(client.publish_times) < len(frames):
+                time.sleep(0.001)
+            elapsed = client.publish_times[-1] - start
+            reader.join()
+            for stage in stages:
+                stage.stop()
+            sinks.close()
+        finally:
+            os.chdir(cwd)
+            close_fake_port(master_fd, slave_fd, ser)
+            client.close()
+
+    latencies = sorted(
+        1000 * (published - sent)
+        for sent, published in zip(send_times, client.publish_times)
+    )
+    return {
+        "rate": rate,
+        "frames": len(frames),
+        "packets_per_s": len(frames) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2],
+        "p99_ms": latencies[int(len(latencies) * 0.99)],
+        "max_ms": latencies[-1],
+    }
+
+
+@main.command()
+@click.option("-o", "--output", default="benchmark.json", show_default=True)
+@click.option("-n", "--frames", type=int, default=20000, show_default=True)
+@click.option(
+    "-r",
+    "--rate",
+    type=float,
+    default=500.0,
+    show_default=True,
+    help="Frames per second of the latency run",
+)
+def suite(output, frames, rate):
+    """
+    Run the micro and end-to-end benchmarks and save the results as JSON
+    """
+    from simulator import make_meters
+
+    # Only known devices, so every frame is formatted and uploaded
+    meters = make_meters(8)
+    frame_list = [meters[i % 8].next_frame() for i in range(frames)]
+
+    results = {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "micro": run_micro(frame_list[:100]),
+        "end_to_end": [
+            run_end_to_end(frame_list, 0),
+            run_end_to_end(frame_list[: int(rate * 10)], rate),
+        ],
+    }
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    for name, result in results["micro"].items():
+        click.echo("%-24s %10.2f us" % (name, result["us_per_op"]))
+    for result in results["end_to_end"]:
+        click.echo(
+            "end-to-end rate %6.0f: %8.0f packets/s  p50 %7.2f ms  "
+            "p99 %7.2f ms"
+            % (
+                result["rate"],
+                result["packets_per_s"],
+                result["p50_ms"],
+                result["p99_ms"],
+            )
+        )
+    click.echo(output)
+
+
+@main.command()
+@click.argument("before", type=click.File())
+@click.argument("after", type=click.File())
+def compare(before, after):
+    """
+    Compare two results files of the benchmark suite
+    """
+    before = json.load(before)
+    after = json.load(after)
+    for name, result in after["micro"].items():
+        if name in before["micro"]:
+            old = before["micro"][name]["us_per_op"]
+            click.echo(
+                "%-24s %10.2f us %10.2f us %+7.1f%%"
+                % (
+                    name,
+                    old,
+                    result["us_per_op"],
+                    100 * (result["us_per_op"] / old - 1),
+                )
+            )
+    before_runs = {run["rate"]: run for run in before["end_to_end"]}
+    for new in after["end_to_end"]:
+        old = before_runs.get(new["rate"])
+        if old is None:
+            continue
+        for key in ("packets_per_s", "p50_ms", "p99_ms"):
+            click.echo(
+                "end-to-end rate %6.0f %-14s %10.2f %10.2f %+7.1f%%"
+                % (
+                    new["rate"],
+                    key,
+                    old[key],
+                    new[key],
+                    100 * (new[key] / old[key] - 1),
+                )
+            )
+
+
+def time_command(args, runs, cwd=None):
+    """
+    Get the shortest time in seconds of runs runs of a command
+    """
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            args,
+            cwd=cwd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+@main.command()
+@click.option("-r", "--runs", type=int, default=5, show_default=True)
+def startup(runs):
+    """
+    Measure the startup time of every command of the logger, as the best of
+    runs runs of the command with --help
+    """
+    import serial_logger
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(here, "serial_logger.py")
+    commands = [
+        ("python", [sys.executable, "-c", "pass"]),
+        (
+            "import serial_logger",
+            [sys.executable, "-c", "import serial_logger"],
+        ),
+        (
+            "import AWS SDK",
+            [sys.executable, "-c", "import AWSIoTPythonSDK.MQTTLib"],
+        ),
+    ]
+    for name in sorted(serial_logger.main.commands):
+        commands.append(
+            (name + " --help", [sys.executable, script, name, "--help"])
+        )
+    commands.append(("print-ports", [sys.executable, script, "print-ports"]))
+    for name, args in commands:
+        try:
+            elapsed = time_command(args, runs, here)
+        except subprocess.CalledProcessError:
+            click.echo("%-24s failed" % name)
+            continue
+        click.echo("%-24s %8.1f ms" % (name, 1000 * elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Batched publishing of readings to the cloud
+"""
+
+import json
+import time
+import zlib
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+
+class BatchPublisher:
+    """
+    Gather readings and publish them as one JSON array per topic
+
+    Readings are grouped per collector ("collectors/<id>/batch") or per
+    sensor type ("collectors/<id>/<type>/batch"). A batch is published when
+    it holds max_count readings or its first reading is window seconds old.
+    Compressed batches are zlib compressed and published with "/zlib"
+    appended to the topic.
+
+    A batch that fails to publish is kept, with the readings added since,
+    and tried again after another window. Publish errors are passed to
+    on_error.
+    """
+
+    def __init__(
+        self,
+        client,
+        collector_id,
+        group_by="collector",
+        window=60.0,
+        max_count=100,
+        compress=False,
+        on_error=None,
+    ):
+        self.client = client
+        self.collector_id = collector_id
+        self.group_by = group_by
+        self.window = window
+        self.max_count = max_count
+        self.compress = compress
+        self.on_error = on_error
+        self._batches = {}
+        # No batches are published before this time after a failed publish
+        self._retry_at = 0.0
+
+    def add(self, sensor_type, data):
+        """
+        Add the data of a reading to its batch
+        """
+        if self.group_by == "type":
+            topic = "collectors/%s/%s/batch" % (self.collector_id, sensor_type)
+        else:
+            topic = "collectors/%s/batch" % self.collector_id
+        batch = self._batches.get(topic)
+        if batch is None:
+            batch = self._batches[topic] = (time.monotonic(), [])
+        batch[1].append(data)
+        if (
+            len(batch[1]) >= self.max_count
+            and time.monotonic() >= self._retry_at
+        ):
+            self._publish(topic)
+        self.flush_due()
+
+    def flush_due(self):
+        """
+        Publish the batches that are older than the window
+        """
+        now = time.monotonic()
+        if now < self._retry_at:
+            return
+        for topic, (started, _) in list(self._batches.items()):
+            if now - started >= self.window:
+                self._publish(topic)
+
+    def flush(self):
+        """
+        Publish all batches
+        """
+        for topic in list(self._batches):
+            self._publish(topic)
+
+    def _publish(self, topic):
+        started, readings = self._batches.pop(topic)
+        payload = json.dumps(readings)
+        publish_topic = topic
+        if self.compress:
+            publish_topic += "/zlib"
+            payload = zlib.compress(payload.encode())
+        try:
+            self.client.publish(publish_topic, payload, 1)
+        except Exception as e:
+            if self.on_error is not None:
+                self.on_error(e)
+            # Keep the readings, ahead of any added since
+            batch = self._batches.get(topic)
+            if batch is not None:
+                readings.extend(batch[1])
+            self._batches[topic] = (started, readings)
+            self._retry_at = time.monotonic() + self.window
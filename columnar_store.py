@@ -0,0 +1,227 @@
+"""
+Compact binary storage of decoded readings
+
+Readings are stored as fixed-width little-endian records, one file per
+device, day and sensor type ("<device>-<date>-<sensor type>.bin"). The time
+of a reading is stored as seconds since the epoch of the local wall-clock
+time, so it matches the times in the csv files. The files can be memory
+mapped as numpy structured arrays, and every field is then a column.
+
+To convert an archive of raw csv files:
+$ python columnar_store.py convert ../../data/2021/
+"""
+
+import calendar
+import click
+import csv
+import functools
+import os
+import re
+import struct
+import time
+
+from mbus_decoder import format_frame, get_profile
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+###############################################################################
+# Global variables
+###############################################################################
+
+# Fields of the records for each sensor type, as numpy type strings
+RECORD_FIELDS = {
+    "flow": [
+        ("time", "<i8"),
+        ("flow1", "<f8"),
+        ("flow2", "<f8"),
+        ("temp", "<i2"),
+        ("diff1", "<i8"),
+        ("diff2", "<i8"),
+        ("rssi", "u1"),
+    ],
+    "pressure": [
+        ("time", "<i8"),
+        ("press_min", "<f8"),
+        ("press_max", "<f8"),
+        ("press_inst", "<f8"),
+        ("rssi", "u1"),
+    ],
+}
+
+# Fields of the formatted packet each record is made from, after the time
+FORMATTED_FIELDS = {
+    "flow": [(1, float), (2, float), (3, int), (4, int), (5, int), (9, int)],
+    "pressure": [(6, float), (7, float), (8, float), (9, int)],
+}
+
+_STRUCT_CODES = {"<i8": "q", "<f8": "d", "<i2": "h", "u1": "B"}
+RECORD_STRUCTS = {
+    sensor_type: struct.Struct(
+        "<" + "".join(_STRUCT_CODES[code] for _, code in fields)
+    )
+    for sensor_type, fields in RECORD_FIELDS.items()
+}
+
+RAW_FILE_PATTERN = re.compile(r"^([0-9a-f]{12})-(\d{4}-\d{2}-\d{2})\.csv$")
+
+
+###############################################################################
+# Main function
+###############################################################################
+@click.group()
+def main():
+    """
+    Compact binary storage of decoded readings
+    """
+    pass
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+@functools.lru_cache(maxsize=64)
+def midnight_epoch(date):
+    """
+    Get the epoch time of midnight of a "%Y-%m-%d" date
+    """
+    return calendar.timegm(time.strptime(date, "%Y-%m-%d"))
+
+
+def get_columnar_path(device_name, date, sensor_type, directory=""):
+    """
+    Get the path of the binary file for a device, day and sensor type
+    """
+    return os.path.join(
+        directory, "%s-%s-%s.bin" % (device_name, date, sensor_type)
+    )
+
+
+def pack_record(sensor_type, epoch, formatted_packet):
+    """
+    Pack a formatted packet into a record
+    """
+    formatted_packet_list = formatted_packet.split(";")
+    return RECORD_STRUCTS[sensor_type].pack(
+        epoch,
+        *[
+            convert(formatted_packet_list[i])
+            for i, convert in FORMATTED_FIELDS[sensor_type]
+        ]
+    )
+
+
+def get_record_dtype(sensor_type):
+    """
+    Get the numpy dtype of the records of a sensor type
+    """
+    import numpy as np
+
+    return np.dtype(RECORD_FIELDS[sensor_type])
+
+
+def load_records(path, sensor_type):
+    """
+    Memory map the records of a binary file as a numpy structured array
+
+    A partly written record at the end of the file is left out.
+    """
+    import numpy as np
+
+    dtype = get_record_dtype(sensor_type)
+    count = os.path.getsize(path) // dtype.itemsize
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+def load_range(directory, device_name, sensor_type, dates):
+    """
+    Memory map the records of a device for a list of "%Y-%m-%d" dates, e.g.
+    all days of a month, as a list with one array per day, skipping days
+    without a file
+
+    Nothing is read until the arrays are used. Join them with
+    numpy.concatenate only when one array is needed, since that reads and
+    copies the whole range.
+    """
+    arrays = []
+    for date in dates:
+        path = get_columnar_path(device_name, date, sensor_type, directory)
+        if os.path.exists(path):
+            arrays.append(load_records(path, sensor_type))
+    return arrays
+
+
+def to_dataframe(records):
+    """
+    Get the records as a pandas DataFrame indexed by time
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(records)
+    df.index = pd.to_datetime(df.pop("time"), unit="s")
+    df.index.name = "Time"
+    return df
+
+
+def find_raw_files(source):
+    """
+    Find all raw "<device>-<date>.csv" files below source, as a dictionary
+    of device name to a date-sorted list of (date, path)
+    """
+    raw_files = {}
+    for dirpath, _, filenames in os.walk(source):
+        for filename in filenames:
+            match = RAW_FILE_PATTERN.match(filename)
+            if match:
+                device_name, date = match.groups()
+                raw_files.setdefault(device_name, []).append(
+                    (date, os.path.join(dirpath, filename))
+                )
+    for days in raw_files.values():
+        days.sort()
+    return raw_files
+
+
+@main.command()
+@click.argument("source", type=click.Path(exists=True, file_okay=False))
+def convert(source):
+    """
+    Convert the raw csv files below SOURCE to binary files next to them
+    """
+    for device_name, days in sorted(find_raw_files(source).items()):
+        # Days are converted in order, since decoding carries state from one
+        # packet to the next
+        for date, raw_path in days:
+            outputs = {}
+            with open(raw_path, newline="") as f:
+                for row in csv.reader(f):
+                    seconds, _, hex_frame = row[0].partition(";")
+                    frame = bytes.fromhex(hex_frame.replace(";", ""))
+                    formatted_packet = format_frame(frame, int(seconds))
+                    if formatted_packet is None:  # Unknown device
+                        continue
+                    sensor_type = get_profile(frame).sensor_type
+                    outputs.setdefault(sensor_type, []).append(
+                        pack_record(
+                            sensor_type,
+                            midnight_epoch(date) + int(seconds),
+                            formatted_packet,
+                        )
+                    )
+            for sensor_type, records in outputs.items():
+                path = get_columnar_path(
+                    device_name,
+                    date,
+                    sensor_type,
+                    os.path.dirname(raw_path),
+                )
+                with open(path, "wb") as f:
+                    f.write(b"".join(records))
+                click.echo(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Live terminal table of the latest reading of every device
+"""
+
+import collections
+import sys
+import threading
+import time
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+# Move the cursor home and clear the screen
+CLEAR_SCREEN = "\x1b[H\x1b[J"
+
+# Arrival times kept per device to get its packet rate
+RATE_WINDOW = 16
+
+
+class Dashboard:
+    """
+    Keep the latest packet of every device and redraw a table of them
+    refresh_rate times per second from a background thread
+
+    update() only stores the packet, and the table is built and written
+    with a single write per redraw, so the cost of the output does not
+    grow with the packet rate.
+    """
+
+    def __init__(self, refresh_rate=2.0, locations=None, out=sys.stdout):
+        self.refresh_rate = refresh_rate
+        self.locations = locations if locations is not None else {}
+        self.out = out
+        self.packets = 0
+        self._started = time.monotonic()
+        # Device to [latest packet, packet count, recent arrival times]
+        self._devices = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="dashboard", daemon=True
+        )
+
+    def update(self, packet):
+        """
+        Store the latest packet of its device
+        """
+        self.packets += 1
+        device = self._devices.get(packet.device_name)
+        if device is None:
+            device = self._devices[packet.device_name] = [
+                packet,
+                0,
+                collections.deque(maxlen=RATE_WINDOW),
+            ]
+        device[0] = packet
+        device[1] += 1
+        device[2].append(time.monotonic())
+
+    def render(self):
+        """
+        Get the table of all devices as one string
+        """
+        now = time.monotonic()
+        lines = [
+            "%d packets from %d devices in %.0f s"
+            % (self.packets, len(self._devices), now - self._started),
+            "",
+            "%-14s %-8s %-34s %5s %8s %8s %7s"
+            % (
+                "device",
+                "location",
+                "last value",
+                "rssi",
+                "packets",
+                "per min",
+                "age s",
+            ),
+        ]
+        for device_name, (packet, count, times) in sorted(
+            list(self._devices.items())
+        ):
+            times = list(times)
+            if len(times) > 1 and times[-1] > times[0]:
+                rate = 60 * (len(times) - 1) / (times[-1] - times[0])
+            else:
+                rate = 0.0
+            lines.append(
+                "%-14s %-8s %-34s %5d %8d %8.1f %7.0f"
+                % (
+                    device_name,
+                    self.locations.get(device_name, ("-",))[0],
+                    format_value(packet.formatted_packet),
+                    packet.frame[-1],
+                    count,
+                    rate,
+                    now - times[-1],
+                )
+            )
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.ident is not None:
+            self._thread.join()
+
+    def _run(self):
+        interval = 1.0 / self.refresh_rate
+        while not self._stop.wait(interval):
+            self.out.write(CLEAR_SCREEN + self.render())
+            self.out.flush()
+
+
+def format_value(formatted_packet):
+    """
+    Get the values of a formatted packet in short form
+    """
+    if formatted_packet is None:
+        return "-"
+    fields = formatted_packet.split(";")
+    if fields[1]:
+        return "%s m3 %s m3 %s C" % (fields[1], fields[2], fields[3])
+    return "%s/%s/%s bar" % (fields[6], fields[7], fields[8])
@@ -0,0 +1,139 @@
+"""
+Cached loading of formatted csv files
+
+A parsed file is stored as a .npz file in a ".cache" directory next to it.
+The cache entry is named after the path, modification time and size of the
+csv file and the date the readings were put on, so an entry is never used
+after the file has changed or for another date. The least
+recently used entries are removed when the cache grows past its size limit.
+"""
+
+import hashlib
+import numpy as np
+import os
+import pandas as pd
+import re
+
+from resampler import FORMATTED_FILE_PATTERN, read_formatted_day
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+CACHE_DIR_NAME = ".cache"
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# pd.to_datetime(..., format="%H:%M:%S") puts the times on this day
+DEFAULT_DATE = "1900-01-01"
+
+
+def get_cache_path(path, date, cache_dir=None):
+    """
+    Get the path of the cache entry for the current version of a file read
+    with its readings on date
+    """
+    stat = os.stat(path)
+    key = "%s\0%d\0%d\0%s" % (
+        os.path.abspath(path),
+        stat.st_mtime_ns,
+        stat.st_size,
+        date,
+    )
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(path), CACHE_DIR_NAME)
+    return os.path.join(
+        cache_dir,
+        "%s-%s-%s.npz"
+        % (
+            os.path.basename(path),
+            date,
+            hashlib.sha1(key.encode()).hexdigest()[:16],
+        ),
+    )
+
+
+def save_frame(cache_path, df):
+    """
+    Save a DataFrame indexed by time with float columns
+    """
+    temp_path = cache_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        np.savez(
+            f,
+            index=df.index.to_numpy(dtype="datetime64[ns]"),
+            columns=np.array(df.columns, dtype=str),
+            values=df.to_numpy(dtype=float),
+        )
+    os.replace(temp_path, cache_path)
+
+
+def load_frame(cache_path):
+    """
+    Load a DataFrame saved with save_frame
+    """
+    with np.load(cache_path) as data:
+        df = pd.DataFrame(
+            data["values"],
+            index=pd.DatetimeIndex(data["index"], name="Time"),
+            columns=data["columns"].tolist(),
+        )
+    return df
+
+
+def remove_old_versions(cache_path):
+    """
+    Remove the entries for earlier versions of the file of a cache entry
+    """
+    cache_dir, name = os.path.split(cache_path)
+    pattern = re.compile(
+        re.escape(name.rpartition("-")[0]) + r"-[0-9a-f]{16}\.npz$"
+    )
+    for entry in os.listdir(cache_dir):
+        if entry != name and pattern.match(entry):
+            os.remove(os.path.join(cache_dir, entry))
+
+
+def prune_cache(cache_dir, max_bytes=CACHE_MAX_BYTES):
+    """
+    Remove the least recently used entries until the cache is at most
+    max_bytes
+    """
+    entries = []
+    for entry in os.listdir(cache_dir):
+        if entry.endswith(".npz"):
+            stat = os.stat(os.path.join(cache_dir, entry))
+            entries.append((stat.st_mtime, stat.st_size, entry))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in entries:
+        if total <= max_bytes:
+            break
+        os.remove(os.path.join(cache_dir, entry))
+        total -= size
+
+
+def load_formatted(path, date=None, cache_dir=None, max_bytes=CACHE_MAX_BYTES):
+    """
+    Load a formatted csv file as a DataFrame indexed by time, from the cache
+    when the file has not changed
+
+    The date of the readings is taken from the file name if date is None and
+    the name has one, otherwise DEFAULT_DATE is used.
+    """
+    if date is None:
+        match = FORMATTED_FILE_PATTERN.match(os.path.basename(path))
+        date = match.group(2) if match else DEFAULT_DATE
+    cache_path = get_cache_path(path, date, cache_dir)
+    if os.path.exists(cache_path):
+        try:
+            df = load_frame(cache_path)
+            # The modification time of an entry is its last use
+            os.utime(cache_path)
+            return df
+        except Exception:  # Damaged entry, parse the file again
+            pass
+
+    df = read_formatted_day(path, date).astype(float)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    save_frame(cache_path, df)
+    remove_old_versions(cache_path)
+    prune_cache(os.path.dirname(cache_path), max_bytes)
+    return df
@@ -0,0 +1,119 @@
+"""
+Aggregated error log for the serial logger
+"""
+
+import csv
+import threading
+import time
+from datetime import datetime
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+# Columns of the error log
+ERROR_LOG_COLUMNS = [
+    "time",
+    "error",
+    "source",
+    "count",
+    "first_seen",
+    "last_seen",
+    "message",
+]
+
+
+class ErrorLog:
+    """
+    Group errors by exception type and source, e.g. a port or device, and
+    write one csv row per group instead of one per error
+
+    The first error of a group is written and printed at once. Repeats are
+    only counted, and every group with new errors is written as a summary
+    when flush_due() is called after interval seconds. The file is opened
+    once, on the first write, and kept open.
+    """
+
+    def __init__(self, path="error_log.csv", interval=60.0):
+        self.path = path
+        self.interval = interval
+        self.last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._file = None
+        self._writer = None
+        # (error, source) to [count, first seen, last seen, message,
+        # count at the last summary]
+        self._groups = {}
+
+    def record(self, e, source=""):
+        """
+        Count an error, and write it if it is the first of its group
+        """
+        error = type(e).__name__
+        now = datetime.today().strftime("%Y-%m-%d/%H:%M:%S")
+        with self._lock:
+            group = self._groups.get((error, source))
+            if group is not None:
+                group[0] += 1
+                group[2] = now
+                group[3] = str(e)
+                return
+            group = self._groups[(error, source)] = [1, now, now, str(e), 1]
+            self._write(error, source, group)
+            self._file.flush()
+        print("Error occured at", now, error, source, e)
+
+    def flush_due(self):
+        """
+        Write a summary of the groups with new errors if interval has
+        passed since the last summary
+        """
+        if time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write a summary of the groups with new errors
+        """
+        self.last_flush = time.monotonic()
+        summary = []
+        with self._lock:
+            for (error, source), group in self._groups.items():
+                if group[0] > group[4]:
+                    self._write(error, source, group)
+                    summary.append((error, source, group[0] - group[4]))
+                    group[4] = group[0]
+            if summary:
+                self._file.flush()
+        for error, source, new in summary:
+            print("%d more %s %s" % (new, error, source))
+
+    def counts(self):
+        """
+        Get the number of errors per (error, source)
+        """
+        with self._lock:
+            return {key: group[0] for key, group in self._groups.items()}
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _write(self, error, source, group):
+        if self._file is None:
+            self._file = open(self.path, "a", newline="")
+            self._writer = csv.writer(self._file, delimiter=",")
+            if self._file.tell() == 0:
+                self._writer.writerow(ERROR_LOG_COLUMNS)
+        self._writer.writerow(
+            [
+                datetime.today().strftime("%Y-%m-%d/%H:%M:%S"),
+                error,
+                source,
+                group[0],
+                group[1],
+                group[2],
+                group[3],
+            ]
+        )
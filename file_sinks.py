@@ -0,0 +1,94 @@
+"""
+Persistent, buffered csv files for the serial logger
+"""
+
+import csv
+import os
+import signal
+import sys
+import time
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+
+class SinkManager:
+    """
+    Keep one open, buffered csv file per target instead of opening the file
+    for every packet
+
+    Files are flushed when their buffer holds flush_bytes, and all files are
+    flushed (and fsynced if fsync is set) every flush_interval seconds. All
+    files are closed when the day rolls over, since every target is a
+    (device, day) or (location, day) file.
+    """
+
+    def __init__(self, flush_bytes=65536, flush_interval=5.0, fsync=False):
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.day = None
+        self.last_flush = time.monotonic()
+        self._sinks = {}
+
+    def write(self, save_loc, packet, day):
+        """
+        Save a data packet in a csv format to the file at save_loc
+        """
+        self._get_sink(save_loc, day, False)[1].writerow([packet])
+        self.flush_if_due()
+
+    def write_bytes(self, save_loc, data, day):
+        """
+        Append data to the binary file at save_loc
+        """
+        self._get_sink(save_loc, day, True)[0].write(data)
+        self.flush_if_due()
+
+    def _get_sink(self, save_loc, day, binary):
+        if day != self.day:
+            self.close()
+            self.day = day
+        sink = self._sinks.get(save_loc)
+        if sink is None:
+            if binary:
+                f = open(save_loc, "ab", buffering=self.flush_bytes)
+                sink = (f, None)
+            else:
+                f = open(save_loc, "a", newline="", buffering=self.flush_bytes)
+                sink = (f, csv.writer(f, delimiter=","))
+            self._sinks[save_loc] = sink
+        return sink
+
+    def flush_if_due(self):
+        """
+        Flush all files if flush_interval has passed since the last flush
+        """
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Flush all files
+        """
+        for f, _ in self._sinks.values():
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Flush and close all files
+        """
+        self.flush()
+        for f, _ in self._sinks.values():
+            f.close()
+        self._sinks.clear()
+
+
+def exit_on_sigterm():
+    """
+    Turn SIGTERM into SystemExit, so open sinks are flushed and closed on the
+    way out like on Ctrl-C
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
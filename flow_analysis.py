@@ -0,0 +1,100 @@
+"""
+Vectorized flow rate and water demand pattern calculation
+
+All functions take cumulative volumes in m^3 as a pandas Series, or a
+DataFrame with one column per meter, indexed by time.
+"""
+
+import pandas as pd
+
+
+def get_volume_diff(volumes, rollover=None):
+    """
+    Get the volume consumed since the previous sample
+
+    rollover is the volume where the meter counter wraps around to zero.
+    Negative differences are taken as a wrap when it is given.
+    """
+    diff = volumes.diff()
+    if rollover is not None:
+        diff = diff.where(~(diff < 0), diff + rollover)
+    return diff
+
+
+def get_flow_rate(volumes, rollover=None, max_gap=None):
+    """
+    Get the average flow rate [L/s] since the previous sample
+
+    The rate is calculated over the actual time between samples, so missing
+    samples do not inflate it. Samples further than max_gap (a Timedelta or
+    string like "30min") from the previous one are set to NaN instead.
+    """
+    seconds = volumes.index.to_series().diff().dt.total_seconds()
+    if isinstance(volumes, pd.DataFrame):
+        seconds = seconds.to_numpy()[:, None]
+    else:
+        seconds = seconds.to_numpy()
+    flow_rate = 1000 * get_volume_diff(volumes, rollover) / seconds
+    if max_gap is not None:
+        gaps = volumes.index.to_series().diff() > pd.Timedelta(max_gap)
+        flow_rate[gaps.to_numpy()] = float("nan")
+    return flow_rate
+
+
+def unwrap_volumes(volumes, rollover):
+    """
+    Get the volumes with the counter rollovers added back, so they keep
+    increasing
+    """
+    diff = get_volume_diff(volumes, rollover).fillna(0)
+    return diff.cumsum() + volumes.iloc[0]
+
+
+def resample_volumes(volumes, interval="10min", max_gap=None):
+    """
+    Get the volumes at every interval, interpolated in time between the
+    samples around it
+
+    Intervals that fall in a gap longer than max_gap between two samples are
+    set to NaN.
+    """
+    grid = pd.date_range(
+        volumes.index[0].ceil(interval),
+        volumes.index[-1].floor(interval),
+        freq=interval,
+    )
+    combined = volumes.reindex(volumes.index.union(grid))
+    resampled = combined.interpolate(method="time").reindex(grid)
+    if max_gap is not None:
+        times = pd.Series(volumes.index, index=volumes.index)
+        previous = times.reindex(grid, method="ffill")
+        following = times.reindex(grid, method="bfill")
+        gaps = (following - previous) > pd.Timedelta(max_gap)
+        resampled[gaps.to_numpy()] = float("nan")
+    return resampled
+
+
+def get_interval_flow_rate(
+    volumes, interval="10min", rollover=None, max_gap=None
+):
+    """
+    Get the average flow rate [L/s] in every interval
+    """
+    if rollover is not None:
+        volumes = unwrap_volumes(volumes, rollover)
+    return get_flow_rate(resample_volumes(volumes, interval, max_gap))
+
+
+def get_demand_pattern(flow_rate, step="1h"):
+    """
+    Get a demand pattern from a flow rate: the mean flow rate for every step
+    of the day divided by the overall mean flow rate
+
+    The result is indexed by the start of each step as an offset from
+    midnight, with one column per meter for DataFrames.
+    """
+    time_of_day = flow_rate.index - flow_rate.index.normalize()
+    slots = time_of_day.floor(step)
+    pattern = flow_rate.groupby(slots).mean()
+    pattern.index.name = "Time of day"
+    return pattern / flow_rate.mean()
@@ -0,0 +1,76 @@
+"""
+Suppression of repeated wM-Bus frames
+"""
+
+import collections
+import time
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+
+class DuplicateFilter:
+    """
+    Remember the frames seen in the last ttl seconds, to drop the copies of
+    a telegram sent several times by a meter or heard by several receivers
+
+    A frame is keyed on all its bytes except the RSSI byte the receiver
+    appends, so the device ID, access number and payload together. At most
+    maxsize frames are remembered, and the least recently seen is forgotten
+    first. A frame is remembered from the time it was first seen, so a copy
+    seen after ttl seconds is let through however often it repeats.
+    """
+
+    def __init__(self, ttl=5.0, maxsize=1024, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+
+        # Counters
+        self.checked = 0
+        self.duplicates = 0
+        self.expired = 0
+        self.evicted = 0
+
+        # Frame key to the time it was first seen, least recently seen first
+        self._seen = collections.OrderedDict()
+
+    def is_duplicate(self, frame):
+        """
+        Check if a frame was already seen in the last ttl seconds, and
+        remember it if not
+        """
+        self.checked += 1
+        now = self.clock()
+        seen = self._seen
+        oldest = now - self.ttl
+        while seen and next(iter(seen.values())) <= oldest:
+            seen.popitem(last=False)
+            self.expired += 1
+
+        key = frame[:-1]
+        first_seen = seen.get(key)
+        if first_seen is not None:
+            if first_seen > oldest:
+                seen.move_to_end(key)
+                self.duplicates += 1
+                return True
+            # Expired, but kept behind a more recently seen frame
+            del seen[key]
+            self.expired += 1
+        if len(seen) >= self.maxsize:
+            seen.popitem(last=False)
+            self.evicted += 1
+        seen[key] = now
+        return False
+
+    def stats(self):
+        """
+        Get the counters of the filter
+        """
+        return {
+            "checked": self.checked,
+            "duplicates": self.duplicates,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "size": len(self._seen),
+        }
@@ -0,0 +1,199 @@
+"""
+Bulk reading of wM-Bus frames from a serial port
+"""
+
+import re
+
+from mbus_decoder import get_max_frame_length
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+# C-fields sent by meters: SND_NR, SND_IR, ACC_NR, ACC_DMD and RSP_UD
+C_FIELDS = bytes((0x44, 0x46, 0x47, 0x48, 0x08))
+
+# L-field, C-field and manufacturer, the bytes checked before a frame is
+# cut out
+HEADER_LENGTH = 4
+
+# Shortest L-field, counting the C-field, manufacturer, address and CI-field
+MIN_L_FIELD = 10
+
+
+def is_valid_header(buffer, start, min_l_field, max_l_field):
+    """
+    Check the L-field, C-field and manufacturer of the frame at start
+
+    The manufacturer is three letters of five bits each, A being 1.
+    """
+    if (
+        not min_l_field <= buffer[start] <= max_l_field
+        or buffer[start + 1] not in C_FIELDS
+    ):
+        return False
+    manufacturer = buffer[start + 2] | buffer[start + 3] << 8
+    return (
+        1 <= manufacturer >> 10 & 0x1F <= 26
+        and 1 <= manufacturer >> 5 & 0x1F <= 26
+        and 1 <= manufacturer & 0x1F <= 26
+    )
+
+
+class FrameReader:
+    """
+    Split the byte stream of a serial port into wM-Bus frames
+
+    Everything waiting in the input buffer is pulled in with a single read
+    into one reusable bytearray. Complete frames are cut out by their
+    L-field through a memoryview, so every frame costs one copy instead of
+    one read call per byte.
+
+    The header of every frame is checked first. After a lost byte or line
+    noise the reader is out of step with the frames, and it skips ahead to
+    the next plausible header, found with a regular expression over the
+    buffer instead of a Python call per byte. The receiver strips the
+    CRCs, so they cannot be checked.
+    """
+
+    def __init__(
+        self, ser, max_read=4096, min_l_field=MIN_L_FIELD, max_l_field=None
+    ):
+        self.ser = ser
+        self.max_read = max_read
+        self.min_l_field = min_l_field
+        # The L-field does not count itself
+        if max_l_field is None:
+            max_l_field = get_max_frame_length() - 1
+        self.max_l_field = max_l_field
+        self.bytes_read = 0
+        self.frames_read = 0
+        self.errors = 0
+        self.resyncs = 0
+        self.bytes_skipped = 0
+        self._buffer = bytearray()
+        # False from a desync until the next frame is found
+        self._synced = True
+        # An L-field in range followed by a C-field
+        self._header = re.compile(
+            b"[%s-%s](?=[%s])"
+            % (
+                re.escape(bytes([min_l_field])),
+                re.escape(bytes([max_l_field])),
+                re.escape(C_FIELDS),
+            )
+        )
+
+    def read_frames(self):
+        """
+        Block until at least one frame is complete and return all complete
+        frames as a list of bytes, each starting with its L-field
+        """
+        frames = self._split_frames()
+        while not frames:
+            try:
+                self._fill()
+            except Exception:
+                self.errors += 1
+                raise
+            frames = self._split_frames()
+        return frames
+
+    def stats(self):
+        """
+        Get the counters of the reader
+        """
+        return {
+            "bytes_read": self.bytes_read,
+            "frames_read": self.frames_read,
+            "errors": self.errors,
+            "resyncs": self.resyncs,
+            "bytes_skipped": self.bytes_skipped,
+        }
+
+    def _fill(self):
+        """
+        Read everything available, or block for a single byte if nothing is
+        waiting
+        """
+        size = min(max(self.ser.in_waiting, 1), self.max_read)
+        data = self.ser.read(size)
+        self.bytes_read += len(data)
+        self._buffer += data
+
+    def _split_frames(self):
+        """
+        Cut all complete frames out of the buffer
+        """
+        buffer = self._buffer
+        buffer_len = len(buffer)
+        frames = []
+        start = 0
+        min_l_field = self.min_l_field
+        max_l_field = self.max_l_field
+        synced = self._synced
+        with memoryview(buffer) as view:
+            while buffer_len - start >= HEADER_LENGTH:
+                # The L-field counts the bytes following it
+                l_field = buffer[start]
+                # The same checks as is_valid_header, inlined
+                manufacturer = buffer[start + 2] | buffer[start + 3] << 8
+                if not (
+                    min_l_field <= l_field <= max_l_field
+                    and buffer[start + 1] in C_FIELDS
+                    and 1 <= manufacturer >> 10 & 0x1F <= 26
+                    and 1 <= manufacturer >> 5 & 0x1F <= 26
+                    and 1 <= manufacturer & 0x1F <= 26
+                ):
+                    start = self._resync(start)
+                    synced = False
+                    continue
+                end = start + l_field + 1
+                if end > buffer_len:
+                    break
+                if not synced:
+                    # Count a desync once it is recovered, however many
+                    # reads it took
+                    self.resyncs += 1
+                    synced = True
+                frames.append(bytes(view[start:end]))
+                start = end
+        # Deleting from the front keeps the allocation for reuse
+        del buffer[:start]
+        self._synced = synced
+        self.frames_read += len(frames)
+        return frames
+
+    def _resync(self, start):
+        """
+        Find the next plausible header after start, or the end of the
+        buffer if there is none
+        """
+        buffer = self._buffer
+        position = start + 1
+        while True:
+            match = self._header.search(buffer, position)
+            if match is None:
+                # A header can still start at the last byte
+                position = max(len(buffer) - 1, position)
+                break
+            position = match.start()
+            if len(buffer) - position < HEADER_LENGTH or is_valid_header(
+                buffer, position, self.min_l_field, self.max_l_field
+            ):
+                break
+            position += 1
+        self.bytes_skipped += position - start
+        return position
+
+
+def get_device_name(frame):
+    """
+    Get device name (ID and manufacturer, most significant byte first)
+    """
+    return frame[7:1:-1].hex()
+
+
+def hex_packet(frame):
+    """
+    Get the semicolon separated hex form of a frame used in the raw files
+    """
+    return frame.hex(";")
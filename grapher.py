@@ -5,6 +5,8 @@ import csv
 import matplotlib.dates as mdates
 import os
 
+from data_cache import load_formatted
+
 
 def add_header(source):
     temp_file = source[0:20] + "2.csv"
@@ -66,8 +68,7 @@ def replace_header(source):
 def graph_data(source):
     graph_name = source[0:10]
 
-    df = pd.read_csv(source, delimiter=";", index_col=False)
-    df["Time"] = pd.to_datetime(df["Time"], format="%H:%M:%S")
+    df = load_formatted(source).reset_index()
     # df0 = pd.DataFrame(df, columns=['Diff 1 [L]','Press Inst [bar]'])
     # print(df0)
     # df0.plot(marker='.')
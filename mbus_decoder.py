@@ -0,0 +1,445 @@
+"""
+Decoder for wM-Bus frames, shared by the live logger and the formatter
+"""
+
+import collections
+import json
+import os
+import struct
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+###############################################################################
+# Global variables
+###############################################################################
+
+# Keep dictionary of sensor specific variables
+# Prefixes are determined by VIF in M-Bus package
+# [location, last_min_pressure_VIF, last_max_pressure_VIF, last_inst_pressure_VIF
+# [location, last_flow1_VIF, last_flow2_VIF, last_temp_VIF, last_flow1_calc, last_flow2_calc]
+sensor_info_dict = {
+    "770004242c2d": ["loc-1", 0x69, 0x69, 0x69],  # PressureSensor
+    "688268302c2d": ["loc-1", 0x13, 0x13, 0x67, -1, -1],  # flowIQ
+    "50902542ce9a": ["loc-2", 0x69, 0x69, 0x69],  # Simulated PressureSensor
+    "51705369ce9a": ["loc-2", 0x13, 0x13, 0x67, -1, -1],  # Simulated flowIQ
+    "51705518ce9a": ["loc-3", 0x69, 0x69, 0x69],  # Simulated PressureSensor
+    "51705538ce9a": ["loc-3", 0x13, 0x13, 0x67, -1, -1],  # Simulated flowIQ
+    "50902294ce9a": ["loc-4", 0x69, 0x69, 0x69],  # Simulated PressureSensor
+    "51705516ce9a": ["loc-4", 0x13, 0x13, 0x67, -1, -1],  # Simulated flowIQ
+}
+
+# Scale factors for every possible VIF, the exponent is held in the lowest
+# bits of the VIF
+PRESSURE_SCALE = tuple(10 ** ((vif & 0x03) - 3) for vif in range(256))
+VOLUME_SCALE = tuple(10 ** ((vif & 0x07) - 6) for vif in range(256))
+TEMPERATURE_SCALE = PRESSURE_SCALE
+
+# Frames are dispatched on (manufacturer, device type, CI field), all read
+# from the frame header
+DeviceProfile = collections.namedtuple(
+    "DeviceProfile",
+    [
+        "name",
+        "sensor_type",
+        "format",
+        "fields",
+        "layout",
+        "vif_offsets",
+        "vif_layout",
+        "min_length",
+        "upload_fields",
+    ],
+)
+MIN_FRAME_LENGTH = 20
+# Longest frame sent by the supported meters, with the RSSI byte
+MAX_FRAME_LENGTH = 48
+device_profiles = {}
+
+# Struct formats of the fields a device profile can decode, unsigned and
+# signed 8, 16 and 32 bit integers
+FIELD_FORMATS = ("B", "H", "I", "b", "h", "i")
+
+# Little-endian data fields
+UINT16 = struct.Struct("<H")
+UINT32 = struct.Struct("<I")
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+def calculate_pressure(VIF, value):
+    """
+    Calculate pressure on M-bus format
+    """
+    return round(value * PRESSURE_SCALE[VIF], 2)
+
+
+def calculate_volume(VIF, value):
+    """
+    Calculate volume on M-bus format
+    """
+    return round(value * VOLUME_SCALE[VIF], 3)
+
+
+def calculate_temperature(VIF, value):
+    """
+    Calculate temperature on M-bus format
+    """
+    return int(value * TEMPERATURE_SCALE[VIF])
+
+
+def calculate_pressure_packet(values, sensor_info):
+    """
+    Format min, max and instant pressure
+    """
+    # [location, last_min_pressure_VIF, last_max_pressure_VIF, last_inst_pressure_VIF
+    press_min_calc = calculate_pressure(sensor_info[1], values[0])
+    press_max_calc = calculate_pressure(sensor_info[2], values[1])
+    press_inst_calc = calculate_pressure(sensor_info[3], values[2])
+    return ";;;;;;%s;%s;%s" % (press_min_calc, press_max_calc, press_inst_calc)
+
+
+def calculate_flow_packet(values, sensor_info):
+    """
+    Format volume 1, volume 2 and temperature, and the volume differences
+    since the last packet from the same meter
+    """
+    # [location, last_flow1_VIF, last_flow2_VIF, last_temp_VIF, last_flow1_calc, last_flow2_calc]
+    volume1_calc = calculate_volume(sensor_info[1], values[0])
+    volume2_calc = calculate_volume(sensor_info[2], values[1])
+    temp_calc = calculate_temperature(sensor_info[3], values[2])
+
+    # diff 1 & 2
+    last_flow1_calc = sensor_info[4]
+    if last_flow1_calc == -1:
+        flow1_diff = 0
+        flow2_diff = 0
+    else:
+        flow1_diff = int(1000 * volume1_calc) - int(1000 * last_flow1_calc)
+        flow2_diff = int(1000 * volume2_calc) - int(1000 * sensor_info[5])
+    sensor_info[4] = volume1_calc
+    sensor_info[5] = volume2_calc
+    return ";%s;%s;%s;%s;%s;;;" % (
+        volume1_calc,
+        volume2_calc,
+        temp_calc,
+        flow1_diff,
+        flow2_diff,
+    )
+
+
+# Format functions for each sensor type, called with the values unpacked by
+# the profile layout
+SENSOR_TYPES = {
+    "flow": calculate_flow_packet,
+    "pressure": calculate_pressure_packet,
+}
+
+# Default upload fields for each sensor type, as (name, column of the
+# formatted packet, type)
+UPLOAD_FIELDS = {
+    "flow": (
+        ("flow_inst", 1, "float"),
+        ("flow_max_month", 2, "float"),
+        ("temp_ambient", 3, "int"),
+        ("flow_inst_diff", 4, "int"),
+        ("flow_max_month_diff", 5, "int"),
+    ),
+    "pressure": (
+        ("min_pressure", 6, "float"),
+        ("max_pressure", 7, "float"),
+        ("inst_pressure", 8, "float"),
+    ),
+}
+UPLOAD_TYPES = {"float": float, "int": int}
+
+
+def compile_layout(fields):
+    """
+    Compile a list of (offset, struct format) fields into one struct that
+    unpacks all of them from a frame at once
+    """
+    layout = "<"
+    position = 0
+    for offset, field_format in fields:
+        if field_format not in FIELD_FORMATS:
+            raise ValueError("unsupported field format %r" % (field_format,))
+        if offset < position:
+            raise ValueError("fields must be in order and not overlap")
+        if offset > position:
+            layout += "%dx" % (offset - position)
+        layout += field_format
+        position = offset + struct.calcsize("<" + field_format)
+    return struct.Struct(layout)
+
+
+def make_profile(
+    name, sensor_type, fields, vif_offsets=(), upload_fields=None
+):
+    """
+    Make a device profile
+
+    fields are the (offset, struct format) of the values passed to the format
+    function of sensor_type. vif_offsets are the offsets of the VIFs for those
+    values, for frames that transmit them. upload_fields are the (name,
+    column, type) of the formatted packet values uploaded to the cloud, by
+    default those of UPLOAD_FIELDS for sensor_type.
+    """
+    if sensor_type not in SENSOR_TYPES:
+        raise ValueError("unknown sensor type %r" % (sensor_type,))
+    if upload_fields is None:
+        upload_fields = UPLOAD_FIELDS[sensor_type]
+    for _, _, field_type in upload_fields:
+        if field_type not in UPLOAD_TYPES:
+            raise ValueError("unknown upload field type %r" % (field_type,))
+    layout = compile_layout(fields)
+    if vif_offsets:
+        vif_layout = compile_layout([(offset, "B") for offset in vif_offsets])
+    else:
+        vif_layout = None
+    return DeviceProfile(
+        name,
+        sensor_type,
+        SENSOR_TYPES[sensor_type],
+        tuple(fields),
+        layout,
+        tuple(vif_offsets),
+        vif_layout,
+        # The RSSI byte follows the last field
+        max(layout.size, vif_layout.size if vif_layout else 0) + 1,
+        tuple(tuple(field) for field in upload_fields),
+    )
+
+
+def get_max_frame_length():
+    """
+    Get the length of the longest frame expected from the supported meters,
+    at least as long as every registered device profile needs
+    """
+    return max(
+        [MAX_FRAME_LENGTH]
+        + [profile.min_length for profile in device_profiles.values()]
+    )
+
+
+def register_profile(manufacturer, device_type, ci_field, profile):
+    """
+    Register a device profile for frames with the given manufacturer
+    (e.g. 0x2c2d), device type and CI field. A ci_field of None matches
+    frames with any CI field.
+    """
+    device_profiles[(manufacturer, device_type, ci_field)] = profile
+
+
+def load_device_profiles(path):
+    """
+    Register the device profiles listed in a JSON file, e.g.
+
+    [{"name": "flowIQ", "manufacturer": "2c2d", "device_type": "16",
+      "ci_field": "78", "sensor_type": "flow",
+      "fields": [[27, "I"], [33, "I"], [39, "B"]],
+      "vif_offsets": [26, 32, 38]}]
+
+    "upload_fields", e.g. [["flow_inst", 1, "float"]], overrides the
+    uploaded values of the sensor type.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    for entry in entries:
+        ci_field = entry.get("ci_field")
+        register_profile(
+            int(entry["manufacturer"], 16),
+            int(entry["device_type"], 16),
+            int(ci_field, 16) if ci_field is not None else None,
+            make_profile(
+                entry["name"],
+                entry["sensor_type"],
+                [tuple(field) for field in entry["fields"]],
+                entry.get("vif_offsets", ()),
+                entry.get("upload_fields"),
+            ),
+        )
+
+
+def get_profile(frame):
+    """
+    Get the device profile of a frame, None if the frame is unknown
+    """
+    if len(frame) < MIN_FRAME_LENGTH:
+        return None
+    key = (UINT16.unpack_from(frame, 2)[0], frame[9], frame[19])
+    profile = device_profiles.get(key)
+    if profile is None:
+        profile = device_profiles.get(key[:2] + (None,))
+    return profile
+
+
+def get_upload_values(profile, formatted_packet):
+    """
+    Get the upload fields of a profile from a formatted packet, as a
+    dictionary
+    """
+    columns = formatted_packet.split(";")
+    return {
+        name: UPLOAD_TYPES[field_type](columns[column])
+        for name, column, field_type in profile.upload_fields
+    }
+
+
+def format_frame(frame, seconds_since_midnight):
+    """
+    Format a frame received on M-bus format into data that is readable
+
+    The frame starts with its L-field and ends with the RSSI byte. Returns
+    None for frames from unknown device models or devices missing in
+    sensor_info_dict.
+    """
+    profile = get_profile(frame)
+    if profile is None or len(frame) < profile.min_length:
+        return None
+    sensor_info = sensor_info_dict.get(frame[7:1:-1].hex())
+    if sensor_info is None:
+        return None
+
+    if profile.vif_layout is not None:  # VIF is transmitted
+        sensor_info[1:4] = profile.vif_layout.unpack_from(frame)
+
+    # Time package was received, same as strftime("%H:%M:%S") on gmtime
+    return "%02d:%02d:%02d%s;%d" % (
+        seconds_since_midnight // 3600 % 24,
+        seconds_since_midnight // 60 % 60,
+        seconds_since_midnight % 60,
+        profile.format(profile.layout.unpack_from(frame), sensor_info),
+        frame[-1],
+    )
+
+
+def format_packet(pac):
+    """
+    Format a packet as stored in the raw files ("<seconds>;<hex>;<hex>;...")
+    """
+    seconds_since_midnight, _, hex_frame = pac.partition(";")
+    frame = bytes.fromhex(hex_frame.replace(";", ""))
+    return format_frame(frame, int(seconds_since_midnight))
+
+
+def get_decoder_state(devices=None):
+    """
+    Get a copy of the decoder state (last VIFs and volumes) of the devices in
+    sensor_info_dict, or of the listed devices
+    """
+    return {
+        device_name: list(sensor_info[1:])
+        for device_name, sensor_info in sensor_info_dict.items()
+        if devices is None or device_name in devices
+    }
+
+
+def set_decoder_state(state, devices=None):
+    """
+    Restore the decoder state of the devices in sensor_info_dict, or of the
+    listed devices, from get_decoder_state. The locations in
+    sensor_info_dict are kept.
+    """
+    for device_name, values in state.items():
+        sensor_info = sensor_info_dict.get(device_name)
+        if sensor_info is None or len(sensor_info) != len(values) + 1:
+            continue
+        if devices is None or device_name in devices:
+            sensor_info[1:] = values
+
+
+def save_decoder_state(path, date, state=None):
+    """
+    Save the decoder state, as of a "%Y-%m-%d" date, to a JSON file
+
+    The file is written next to path and renamed over it, so a crash leaves
+    either the old or the new snapshot.
+    """
+    if state is None:
+        state = get_decoder_state()
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"date": date, "devices": state}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def read_decoder_state(path):
+    """
+    Read a snapshot written by save_decoder_state as (date, state), or
+    (None, {}) if there is no readable snapshot
+    """
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+        return snapshot["date"], snapshot["devices"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None, {}
+
+
+###############################################################################
+# Device profiles
+###############################################################################
+
+KAMSTRUP = 0x2C2D
+SIMULATED = 0xCE9A
+
+register_profile(
+    KAMSTRUP,
+    0x16,
+    0x78,  # VIF is transmitted
+    make_profile(
+        "Kamstrup flowIQ",
+        "flow",
+        [(27, "I"), (33, "I"), (39, "B")],
+        (26, 32, 38),
+    ),
+)
+register_profile(
+    KAMSTRUP,
+    0x16,
+    0x79,  # VIF is not transmitted
+    make_profile("Kamstrup flowIQ", "flow", [(26, "I"), (30, "I"), (34, "B")]),
+)
+register_profile(
+    KAMSTRUP,
+    0x18,
+    0x78,  # VIF is transmitted
+    make_profile(
+        "Kamstrup PressureSensor",
+        "pressure",
+        [(22, "H"), (26, "H"), (30, "H")],
+        (21, 25, 29),
+    ),
+)
+register_profile(
+    KAMSTRUP,
+    0x18,
+    0x79,  # VIF is not transmitted
+    make_profile(
+        "Kamstrup PressureSensor",
+        "pressure",
+        [(24, "H"), (26, "H"), (28, "H")],
+    ),
+)
+register_profile(
+    SIMULATED,
+    0x16,
+    None,
+    make_profile(
+        "Simulated flowIQ", "flow", [(27, "I"), (31, "I"), (35, "B")]
+    ),
+)
+register_profile(
+    SIMULATED,
+    0x18,
+    None,
+    make_profile(
+        "Simulated PressureSensor",
+        "pressure",
+        [(25, "H"), (27, "H"), (29, "H")],
+    ),
+)
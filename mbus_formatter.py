@@ -1,268 +1,321 @@
+import click
+import concurrent.futures
 import csv
-import time
-
-# Keep dictionary of sensor specific variables
-# Prefixes are determined by VIF in M-Bus package
-# [location, last_min_pressure_VIF, last_max_pressure_VIF, last_inst_pressure_VIF
-# [location, last_flow1_VIF, last_flow2_VIF, last_temp_VIF, last_flow1_calc, last_flow2_calc]
-sensor_info_dict = {
-    "770004242c2d": ["loc-1", "69", "69", "69"],  # PressureSensor
-    "688268302c2d": ["loc-1", "13", "13", "67", -1, -1],  # flowIQ
-    "50902542ce9a": ["loc-2", "69", "69", "69"],  # Simulated PressureSensor
-    "51705369ce9a": ["loc-2", "13", "13", "67", -1, -1],  # Simulated flowIQ
-    "51705518ce9a": ["loc-3", "69", "69", "69"],  # Simulated PressureSensor
-    "51705538ce9a": ["loc-3", "13", "13", "67", -1, -1],  # Simulated flowIQ
-    "50902294ce9a": ["loc-4", "69", "69", "69"],  # Simulated PressureSensor
-    "51705516ce9a": ["loc-4", "13", "13", "67", -1, -1],  # Simulated flowIQ
+import functools
+import numpy as np
+import os
+
+from columnar_store import find_raw_files
+from mbus_decoder import (
+    calculate_pressure,
+    calculate_temperature,
+    calculate_volume,
+    format_frame,
+    format_packet,
+    get_decoder_state,
+    get_profile,
+    MIN_FRAME_LENGTH,
+    read_decoder_state,
+    save_decoder_state,
+    sensor_info_dict,
+    set_decoder_state,
+)
+
+# numpy types of the struct formats used in device profiles, one for every
+# format in FIELD_FORMATS
+FIELD_DTYPES = {
+    "B": "<u1",
+    "H": "<u2",
+    "I": "<u4",
+    "b": "<i1",
+    "h": "<i2",
+    "i": "<i4",
 }
 
+# Bits of the value in the keys of calculate_unique
+VALUE_MASK = 0xFFFFFFFFFF
+VALUE_SIGN = 0x8000000000
 
-def calculate_pressure(VIF, D1, D2):
+
+def save_packets(save_loc, packets, mode="a"):
     """
-    Calculate pressure on M-bus format
+    Save a list of data packets in a csv format with one write
     """
-    # Extract bit 1 and 2 from hex number located at temp_pac[22]
-    prefix_bin = bin(int(VIF, 16))[2:].zfill(8)[6:9]
-    prefix = 10 ** (int(prefix_bin, 2) - 3)
-    hex_value = D1 + D2
-    dec_value = int(hex_value, 16) * prefix
-    return round(dec_value, 2)
+    with open(save_loc, mode, newline="") as f:
+        writer = csv.writer(f, delimiter=",")
+        writer.writerows([packet] for packet in packets)
 
 
-def calculate_volume(VIF, D1, D2, D3, D4):
+def read_raw_packets(raw_file):
     """
-    Calculate volume on M-bus format
+    Read the packets of a raw file
     """
-    # Extract bit 1 and 2 from hex number located at temp_pac[23]
-    prefix_bin = bin(int(VIF, 16))[2:].zfill(8)[5:9]
-    prefix = 10 ** (int(prefix_bin, 2) - 6)
-    hex_value = D1 + D2 + D3 + D4
-    int_value = int(hex_value, 16) * prefix
-    return round(int_value, 3)
+    with open(raw_file, newline="") as f:
+        return [row[0] for row in csv.reader(f)]
 
 
-def calculate_temperature(VIF, D1):
+def format_packets(packets):
     """
-    Calculate temperature on M-bus format
+    Format packets one by one, skipping unknown devices
     """
-    # Extract bit 1 and 2 from hex number located at temp_pac[22]
-    prefix_bin = bin(int(VIF, 16))[2:].zfill(8)[6:9]
-    prefix = 10 ** (int(prefix_bin, 2) - 3)
-    hex_value = D1
-    # print("variables are ", str(hex_value), " and ", str(prefix))
-    int_value = int(hex_value, 16) * prefix
-    # print("returning ", str(int_value))
-    return int(int_value)
+    formatted_packets = []
+    for packet in packets:
+        formatted_packet = format_packet(packet)
+        if formatted_packet is not None:
+            formatted_packets.append(formatted_packet)
+    return formatted_packets
 
 
-def calculate_pressure_packet(pac_list, i1, i2, i3):
-    device_name = (
-        pac_list[8]
-        + pac_list[7]
-        + pac_list[6]
-        + pac_list[5]
-        + pac_list[4]
-        + pac_list[3]
-    )
+def forward_fill_vifs(vifs, last_vifs):
+    """
+    Get the VIF in effect for every row of vifs, where rows without
+    transmitted VIFs are -1 and use the VIFs of the row before. The first
+    rows use last_vifs until a VIF is transmitted.
+    """
+    rows = np.arange(len(vifs))
+    filled = np.empty_like(vifs)
+    for column in range(vifs.shape[1]):
+        transmitted = vifs[:, column] >= 0
+        last_transmitted = np.maximum.accumulate(
+            np.where(transmitted, rows, -1)
+        )
+        filled[:, column] = np.where(
+            last_transmitted >= 0,
+            vifs[last_transmitted, column],
+            last_vifs[column],
+        )
+    return filled
+
+
+@functools.lru_cache(maxsize=1)
+def get_time_strings():
+    """
+    Get the "%H:%M:%S" string of every second of the day
+    """
+    return [
+        "%02d:%02d:%02d" % (t // 3600, t // 60 % 60, t % 60)
+        for t in range(86400)
+    ]
 
-    # [location, last_min_pressure_VIF, last_max_pressure_VIF, last_inst_pressure_VIF
-    global sensor_info_dict
-    last_min_pressure_VIF = sensor_info_dict[device_name][1]
-    last_max_pressure_VIF = sensor_info_dict[device_name][2]
-    last_inst_pressure_VIF = sensor_info_dict[device_name][3]
 
-    # Min pressure
-    press_min_calc = calculate_pressure(
-        last_min_pressure_VIF, pac_list[i1], pac_list[i1 - 1]
-    )
-    pressure_pac = ";;;;;;" + str(press_min_calc)
+def unpack_value(value):
+    """
+    Get a value packed into the low 40 bits of a key by calculate_unique
+    """
+    if value & VALUE_SIGN:
+        return value - (VALUE_MASK + 1)
+    return value
 
-    # Max pressure
-    press_max_calc = calculate_pressure(
-        last_max_pressure_VIF, pac_list[i2], pac_list[i2 - 1]
-    )
-    pressure_pac += ";" + str(press_max_calc)
 
-    # Instant pressure
-    press_inst_calc = calculate_pressure(
-        last_inst_pressure_VIF, pac_list[i3], pac_list[i3 - 1]
-    )
-    pressure_pac += ";" + str(press_inst_calc)
-    return pressure_pac
-
-
-def calculate_flow_packet(pac_list, i1, i2, i3):
-    device_name = (
-        pac_list[8]
-        + pac_list[7]
-        + pac_list[6]
-        + pac_list[5]
-        + pac_list[4]
-        + pac_list[3]
-    )
-    # [location, last_flow1_VIF, last_flow2_VIF, last_temp_VIF, last_flow1_calc, last_flow2_calc]
-    global sensor_info_dict
-    last_flow1_VIF = sensor_info_dict[device_name][1]
-    last_flow2_VIF = sensor_info_dict[device_name][2]
-    last_temp_VIF = sensor_info_dict[device_name][3]
-    last_flow1_calc = sensor_info_dict[device_name][4]
-    last_flow2_calc = sensor_info_dict[device_name][5]
-    # flow 1
-    volume1_calc = calculate_volume(
-        last_flow1_VIF,
-        pac_list[i1],
-        pac_list[i1 - 1],
-        pac_list[i1 - 2],
-        pac_list[i1 - 3],
+def calculate_unique(function, vifs, values):
+    """
+    Call function(VIF, value) once for every distinct pair of vifs and
+    values, and get the results and their text as object arrays in the
+    order of values
+    """
+    # The value, at most 32 bits and possibly negative, is kept in the low
+    # 40 bits of the key as two's complement, so the VIF is not overwritten
+    keys = vifs.astype(np.int64) << 40 | values.astype(np.int64) & VALUE_MASK
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    results = np.empty(len(unique_keys), dtype=object)
+    results[:] = [
+        function(key >> 40, unpack_value(key & VALUE_MASK))
+        for key in unique_keys.tolist()
+    ]
+    texts = np.array([str(result) for result in results], dtype=object)
+    inverse = inverse.reshape(-1)
+    return results[inverse], texts[inverse]
+
+
+def format_device_frames(profiles, values, vifs, times, rssi, sensor_info):
+    """
+    Format the frames of one device, in the order they were received, like
+    format_frame would one by one
+
+    values and vifs hold the three fields and VIFs of every frame, with -1
+    for VIFs that are not transmitted. The VIFs in effect and the volume
+    differences are computed over all frames at once, and every distinct
+    value is only scaled and rounded once.
+    """
+    vifs = forward_fill_vifs(vifs, sensor_info[1:4])
+    sensor_info[1:4] = vifs[-1].tolist()
+    time_strings = get_time_strings()
+    time_strings = [time_strings[t % 86400] for t in times.tolist()]
+    rssi = rssi.tolist()
+
+    if profiles[0].sensor_type == "pressure":
+        pressures = [
+            calculate_unique(calculate_pressure, vifs[:, i], values[:, i])[1]
+            for i in range(3)
+        ]
+        return [
+            "%s;;;;;;%s;%s;%s;%d" % row
+            for row in zip(time_strings, *pressures, rssi)
+        ]
+
+    volume1, volume1_texts = calculate_unique(
+        calculate_volume, vifs[:, 0], values[:, 0]
     )
-    flow_pac = ";" + str(volume1_calc)
-
-    # flow 2
-    volume2_calc = calculate_volume(
-        last_flow2_VIF,
-        pac_list[i2],
-        pac_list[i2 - 1],
-        pac_list[i2 - 2],
-        pac_list[i2 - 3],
+    volume2, volume2_texts = calculate_unique(
+        calculate_volume, vifs[:, 1], values[:, 1]
     )
-    flow_pac += ";" + str(volume2_calc)
-
-    # temperature
-    # print("lets calculate som temperature with ", str(i3))
-    temp_calc = calculate_temperature(last_temp_VIF, pac_list[i3])
-    flow_pac += ";" + str(temp_calc)
-
-    # diff 1 & 2
-    if last_flow1_calc == -1:
-        flow_pac += ";" + "0"
-        flow_pac += ";" + "0"
-        sensor_info_dict[device_name][4] = volume1_calc
-        sensor_info_dict[device_name][5] = volume2_calc
-    else:
-        flow1_diff = int(1000 * volume1_calc) - int(1000 * last_flow1_calc)
-        flow2_diff = int(1000 * volume2_calc) - int(1000 * last_flow2_calc)
-        flow_pac += ";" + str(flow1_diff)
-        flow_pac += ";" + str(flow2_diff)
-        sensor_info_dict[device_name][4] = volume1_calc
-        sensor_info_dict[device_name][5] = volume2_calc
-    flow_pac += ";;;"
-    return flow_pac
-
-
-def format_packet(pac):
-    """
-    Format packets received on M-bus format into data that is readable
-    """
-    global sensor_info_dict
-
-    temp_pac = pac.split(";")
-    device_name = (
-        temp_pac[8]
-        + temp_pac[7]
-        + temp_pac[6]
-        + temp_pac[5]
-        + temp_pac[4]
-        + temp_pac[3]
+    _, temperature_texts = calculate_unique(
+        calculate_temperature, vifs[:, 2], values[:, 2]
     )
 
-    new_pac = ""
-
-    # Time package was received
-    new_pac += time.strftime("%H:%M:%S", time.gmtime(int(temp_pac[0])))
+    # diff 1 & 2, in litres between consecutive packets
+    diffs = []
+    for volumes, last_index in ((volume1, 4), (volume2, 5)):
+        litres = np.trunc(volumes.astype(np.float64) * 1000)
+        diff = np.diff(litres.astype(np.int64), prepend=0)
+        last_volume = sensor_info[last_index]
+        if last_volume == -1:
+            diff[0] = 0
+        else:
+            diff[0] -= int(1000 * last_volume)
+        diffs.append(diff.tolist())
+        sensor_info[last_index] = volumes[-1]
+
+    return [
+        "%s;%s;%s;%s;%d;%d;;;;%d" % row
+        for row in zip(
+            time_strings,
+            volume1_texts,
+            volume2_texts,
+            temperature_texts,
+            *diffs,
+            rssi,
+        )
+    ]
+
+
+def gather(data, starts, offset, dtype):
+    """
+    Get the little-endian field at offset of every frame starting at starts
+    """
+    dtype = np.dtype(dtype)
+    columns = starts[:, None] + (offset + np.arange(dtype.itemsize))
+    return np.ascontiguousarray(data[columns]).view(dtype)[:, 0]
 
-    packet_type = temp_pac[10]
-    man_id_1 = temp_pac[3]
-    man_id_2 = temp_pac[4]
 
-    if (
-        man_id_1 == "2d" and man_id_2 == "2c" and packet_type == "16"
-    ):  # Kamstrup flowIQ
-        if temp_pac[20] == "78":  # VIF is transmitted
-            # last_flow1_VIF
-            sensor_info_dict[device_name][1] = temp_pac[27]
-            # last_flow2_VIF
-            sensor_info_dict[device_name][2] = temp_pac[33]
-            # last_temp_VIF
-            sensor_info_dict[device_name][3] = temp_pac[39]
-            i1 = 31
-            i2 = 37
-            i3 = 40
-        elif temp_pac[20] == "79":  # VIF is not transmitted
-            i1 = 30
-            i2 = 34
-            i3 = 35
-        new_pac += calculate_flow_packet(temp_pac, i1, i2, i3)
-
-    elif (
-        man_id_1 == "2d" and man_id_2 == "2c" and packet_type == "18"
-    ):  # Kamstrup PressureSensor
-        if temp_pac[20] == "78":  # VIF is transmitted
-            # last_min_pressure_VIF
-            sensor_info_dict[device_name][1] = temp_pac[22]
-            # last_max_pressure_VIF
-            sensor_info_dict[device_name][2] = temp_pac[26]
-            # last_inst_pressure_VIF
-            sensor_info_dict[device_name][3] = temp_pac[30]
-            i1 = 24
-            i2 = 28
-            i3 = 32
-        elif temp_pac[20] == "79":  # VIF is not transmitted
-            i1 = 26
-            i2 = 28
-            i3 = 30
-        new_pac += calculate_pressure_packet(temp_pac, i1, i2, i3)
-
-    elif (
-        man_id_1 == "9a" and man_id_2 == "ce" and packet_type == "16"
-    ):  # Simulated flowIQ
-        i1 = 31
-        i2 = 35
-        i3 = 36
-        new_pac += calculate_flow_packet(temp_pac, i1, i2, i3)
-
-    elif (
-        man_id_1 == "9a" and man_id_2 == "ce" and packet_type == "18"
-    ):  # Simulated PressureSensor
-        i1 = 27
-        i2 = 29
-        i3 = 31
-        new_pac += calculate_pressure_packet(temp_pac, i1, i2, i3)
-
-    else:
-        print("unknown packet")
-
-    rssi_hex = str(pac[-2]) + str(pac[-1])
-    rssi_int = int(rssi_hex, 16)
-    new_pac += ";" + str(rssi_int)
-
-    return new_pac
-
-
-def print_packet(packet):
-    """
-    Print a data packet
-    """
-    packet_list = packet.split(";")
-    for i in packet_list:
-        print(i, end="\t")
-    print(" ")
-
-
-def save_packet(save_loc, packet):
-    """
-    Save a data packet in a csv format
-    """
-    with open(save_loc, "a", newline="") as f:
-        writer = csv.writer(f, delimiter=",")
-        writer.writerow([packet])
+def format_packets_batch(packets):
+    """
+    Format packets like format_packets, decoding the fields of all packets
+    at once
 
+    All frames are parsed into one uint8 array in a single call, and the
+    header and fields of every frame are gathered from it with vectorized
+    indexing, grouped by device and device profile.
+    """
+    if not packets:
+        return []
+    times, hex_frames = zip(*(packet.split(";", 1) for packet in packets))
+    times = np.fromiter(map(int, times), np.int64, len(times))
+    lengths = (np.fromiter(map(len, hex_frames), np.int64) + 1) // 3
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    data = np.frombuffer(
+        bytes.fromhex(";".join(hex_frames).replace(";", "")), dtype=np.uint8
+    )
 
+    # Look up the profile of every distinct header, frames too short for a
+    # header are rejected
+    valid = lengths >= MIN_FRAME_LENGTH
+    starts = starts[valid]
+    lengths = lengths[valid]
+    times = times[valid]
+    header_keys = (
+        gather(data, starts, 2, "<u2").astype(np.int64)
+        | gather(data, starts, 9, "<u1").astype(np.int64) << 16
+        | gather(data, starts, 19, "<u1").astype(np.int64) << 24
+    )
+    device_keys = gather(data, starts, 2, "<u8") & 0xFFFFFFFFFFFF
+
+    formatted_packets = [None] * len(starts)
+    groups = np.unique(
+        np.stack([device_keys, header_keys]), axis=1, return_inverse=True
+    )[1].reshape(-1)
+    devices = {}
+    for group in np.unique(groups):
+        rows = np.flatnonzero(groups == group)
+        first = starts[rows[0]]
+        frame_header = data[first : first + MIN_FRAME_LENGTH].tobytes()
+        profile = get_profile(frame_header)
+        device_name = frame_header[7:1:-1].hex()
+        if profile is None or device_name not in sensor_info_dict:
+            continue
+        rows = rows[lengths[rows] >= profile.min_length]
+        devices.setdefault(device_name, []).append((profile, rows))
+
+    for device_name, layouts in devices.items():
+        rows = np.sort(np.concatenate([rows for _, rows in layouts]))
+        if len(rows) == 0:
+            continue
+        if len({profile.sensor_type for profile, _ in layouts}) > 1:
+            # Mixed sensor types, fall back to formatting one by one
+            for row in rows:
+                start = starts[row]
+                formatted_packets[row] = format_frame(
+                    data[start : start + lengths[row]].tobytes(), times[row]
+                )
+            continue
+
+        # Fields and VIFs of every frame of the device, in received order
+        values = np.zeros((len(rows), 3), dtype=np.int64)
+        vifs = np.full((len(rows), 3), -1, dtype=np.int16)
+        for profile, layout_rows in layouts:
+            positions = np.searchsorted(rows, layout_rows)
+            layout_starts = starts[layout_rows]
+            for column, (offset, field_format) in enumerate(profile.fields):
+                values[positions, column] = gather(
+                    data, layout_starts, offset, FIELD_DTYPES[field_format]
+                )
+            for column, offset in enumerate(profile.vif_offsets):
+                vifs[positions, column] = data[layout_starts + offset]
+
+        formatted_rows = format_device_frames(
+            [profile for profile, _ in layouts],
+            values,
+            vifs,
+            times[rows],
+            data[starts[rows] + lengths[rows] - 1],
+            sensor_info_dict[device_name],
+        )
+        for row, formatted_packet in zip(rows.tolist(), formatted_rows):
+            formatted_packets[row] = formatted_packet
+    return [packet for packet in formatted_packets if packet is not None]
+
+
+###############################################################################
+# Main function
+###############################################################################
+@click.group()
 def main():
-    source_location = "../../data/2021/05-mai/"
-    flow_meter = "688268302c2d"
-    pressure_meter = "770004242c2d"
-    date = "2021-05-22"
-
+    """
+    Script for formatting raw wM-Bus packets saved by the serial logger
+    """
+    pass
+
+
+###############################################################################
+# Commands
+###############################################################################
+
+
+@main.command()
+@click.option("--source-location", default="../../data/2021/05-mai/")
+@click.option("--flow-meter", default="688268302c2d")
+@click.option("--pressure-meter", default="770004242c2d")
+@click.option("--date", default="2021-05-22")
+@click.option(
+    "--batch",
+    type=bool,
+    default=True,
+    help="Decode whole files at once, False for one by one",
+)
+def format_day(source_location, flow_meter, pressure_meter, date, batch):
+    """
+    Format one day of a flow meter and a pressure meter
+    """
     flow_file = source_location + flow_meter + "-" + date + ".csv"
     pressure_file = source_location + pressure_meter + "-" + date + ".csv"
 
@@ -274,21 +327,181 @@ def main():
         + "-formatted.csv"
     )
 
-    with open(flow_file) as csv_flow_file:
-        csv_reader = csv.reader(csv_flow_file)
-        for row in csv_reader:
-            # print(row)
-            formatted_packet = format_packet(row[0])
-            print_packet(flow_meter + ";" + formatted_packet)
-            save_packet(formatted_save_loc, formatted_packet)
-
-    with open(pressure_file) as csv_pressure_file:
-        csv_reader = csv.reader(csv_pressure_file)
-        for row in csv_reader:
-            # print(row)
-            formatted_packet = format_packet(row[0])
-            print_packet(pressure_meter + ";" + formatted_packet)
-            save_packet(formatted_save_loc, formatted_packet)
+    for device_name, raw_file in (
+        (flow_meter, flow_file),
+        (pressure_meter, pressure_file),
+    ):
+        packets = read_raw_packets(raw_file)
+        if batch:
+            formatted_packets = format_packets_batch(packets)
+        else:
+            formatted_packets = format_packets(packets)
+        save_packets(formatted_save_loc, formatted_packets)
+        print(device_name, len(formatted_packets), "packets formatted")
+
+
+def get_backfill_tasks(source):
+    """
+    Group the raw files below source by location and day, as a dictionary of
+    location to a date-sorted list of (date, [(device, path), ...])
+
+    Flow meters are listed before the other devices of a day, like in the
+    files written by format_day.
+    """
+    locations = {}
+    for device_name, days in find_raw_files(source).items():
+        if device_name not in sensor_info_dict:
+            continue
+        location = sensor_info_dict[device_name][0]
+        for date, raw_path in days:
+            locations.setdefault(location, {}).setdefault(date, []).append(
+                (device_name, raw_path)
+            )
+    return {
+        location: [
+            (
+                date,
+                sorted(
+                    devices,
+                    key=lambda device: (
+                        len(sensor_info_dict[device[0]]) != 6,
+                        device[0],
+                    ),
+                ),
+            )
+            for date, devices in sorted(days.items())
+        ]
+        for location, days in locations.items()
+    }
+
+
+def get_formatted_path(location, date, devices):
+    """
+    Get the path of the formatted file of a location and day, next to the
+    raw files
+    """
+    return os.path.join(
+        os.path.dirname(devices[0][1]),
+        location + "_" + date + "-formatted.csv",
+    )
+
+
+def is_up_to_date(formatted_path, devices):
+    """
+    Check if a formatted file is newer than all raw files it is made from
+    """
+    if not os.path.exists(formatted_path):
+        return False
+    formatted_mtime = os.path.getmtime(formatted_path)
+    return all(
+        os.path.getmtime(raw_path) <= formatted_mtime
+        for _, raw_path in devices
+    )
+
+
+def backfill_location(location, days, force, snapshot=(None, {})):
+    """
+    Format the days of a location in order, so the decoder state of its
+    devices carries from one day to the next
+
+    Days up to the first day that is out of date are skipped, except the
+    day before it, which is decoded to restore the decoder state. From then
+    on every day is formatted again, since its first volume differences
+    depend on the day before.
+
+    The decoder state starts from snapshot, a (date, state) pair from
+    read_decoder_state, if it is older than the first day decoded. Returns
+    the formatted paths and the decoder state of the location's devices
+    after the last day, or None if nothing was formatted.
+    """
+    first = 0
+    if not force:
+        while first < len(days) and is_up_to_date(
+            get_formatted_path(location, *days[first]), days[first][1]
+        ):
+            first += 1
+    if first == len(days):
+        return [], None
+
+    location_devices = {
+        device_name for _, devices in days for device_name, _ in devices
+    }
+    snapshot_date, state = snapshot
+    if (
+        snapshot_date is not None
+        and snapshot_date < days[max(first - 1, 0)][0]
+    ):
+        set_decoder_state(state, location_devices)
+
+    if first > 0:
+        for _, raw_path in days[first - 1][1]:
+            format_packets_batch(read_raw_packets(raw_path))
+
+    formatted_paths = []
+    for date, devices in days[first:]:
+        formatted_packets = []
+        for _, raw_path in devices:
+            formatted_packets += format_packets_batch(
+                read_raw_packets(raw_path)
+            )
+        formatted_path = get_formatted_path(location, date, devices)
+        save_packets(formatted_path + ".tmp", formatted_packets, "w")
+        os.replace(formatted_path + ".tmp", formatted_path)
+        formatted_paths.append(formatted_path)
+    return formatted_paths, get_decoder_state(location_devices)
+
+
+@main.command()
+@click.argument("source", type=click.Path(exists=True, file_okay=False))
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of processes, defaults to the number of cores",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Format all days, also the ones that are up to date",
+)
+@click.option(
+    "--state-file",
+    help="Decoder state snapshot to start from, updated with the state "
+    "after the last day unless it is newer",
+)
+def backfill(source, workers, force, state_file):
+    """
+    Format all raw "<device>-<date>.csv" files below SOURCE
+
+    Each location is formatted by its own process, one day at a time.
+    """
+    tasks = get_backfill_tasks(source)
+    snapshot = (None, {})
+    if state_file:
+        snapshot = read_decoder_state(state_file)
+    state = dict(snapshot[1])
+    last_date = None
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = {
+            executor.submit(
+                backfill_location, location, days, force, snapshot
+            ): location
+            for location, days in tasks.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            formatted_paths, location_state = future.result()
+            click.echo(
+                "%s: %d days formatted"
+                % (futures[future], len(formatted_paths))
+            )
+            if location_state is not None:
+                state.update(location_state)
+                last_date = max(last_date or "", tasks[futures[future]][-1][0])
+
+    # A snapshot from the live logger is newer than the archive
+    if state_file and last_date and (snapshot[0] or "") <= last_date:
+        save_decoder_state(state_file, last_date, state)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,206 @@
+"""
+Counters and histograms served as Prometheus text over HTTP
+"""
+
+import bisect
+import http.server
+import threading
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+# Buckets in seconds for the durations of single operations
+DURATION_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+
+def format_labels(names, values, extra=""):
+    """
+    Format label names and values as {name="value",...}
+    """
+    labels = ['%s="%s"' % (name, value) for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(labels) + "}"
+
+
+class Counter:
+    """
+    A counter per combination of label values
+
+    inc() only adds to a dictionary entry under a lock, so it is cheap
+    enough to call for every frame, from any thread.
+    """
+
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = (
+                self._values.get(label_values, 0) + amount
+            )
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield self.name + format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    """
+    A histogram per combination of label values, with cumulative buckets
+    like Prometheus histograms, safe to update from several threads
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DURATION_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # [count per bucket..., count above the last bucket, sum]
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (
+                    len(self.buckets) + 1
+                ) + [0.0]
+            counts[bucket] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [
+                (label_values, list(counts))
+                for label_values, counts in self._values.items()
+            ]
+        for label_values, counts in values:
+            total = 0
+            for bucket, count in zip(self.buckets, counts):
+                total += count
+                yield self.name + "_bucket" + format_labels(
+                    self.labels, label_values, 'le="%g"' % bucket
+                ), total
+            total += counts[-2]
+            yield self.name + "_bucket" + format_labels(
+                self.labels, label_values, 'le="+Inf"'
+            ), total
+            labels = format_labels(self.labels, label_values)
+            yield self.name + "_count" + labels, total
+            yield self.name + "_sum" + labels, counts[-1]
+
+
+class Callback:
+    """
+    A gauge or counter read from function when the metrics are served
+
+    function returns a number, or a dictionary of label values to numbers.
+    """
+
+    def __init__(self, name, help, function, labels=(), type="gauge"):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.labels = tuple(labels)
+        self.type = type
+
+    def samples(self):
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            yield self.name + format_labels(self.labels, label_values), value
+
+
+class Registry:
+    """
+    A set of metrics rendered together
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Get all metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for name, value in metric.samples():
+                lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of the logger
+registry = Registry()
+
+
+def serve(port, address="127.0.0.1", registry=registry):
+    """
+    Serve the metrics of registry at http://address:port/metrics from a
+    background thread
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+            )
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((address, port), Handler)
+    threading.Thread(
+        target=server.serve_forever, name="metrics", daemon=True
+    ).start()
+    return server
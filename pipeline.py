@@ -0,0 +1,163 @@
+"""
+Worker threads connected by bounded queues
+"""
+
+import queue
+import threading
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+# What to do with an item when the queue of a stage is full
+DROP_POLICIES = ("block", "drop-newest", "drop-oldest")
+
+# Put in a queue to stop the worker reading it
+_STOP = object()
+
+
+class Stage:
+    """
+    A worker thread that runs handler on every item put in its queue and
+    passes the result, unless it is None, on to the connected stages
+
+    idle_handler is called every idle_interval seconds while the queue is
+    empty, e.g. to flush buffers. Exceptions raised by the handlers are
+    passed to on_error.
+    """
+
+    def __init__(
+        self,
+        name,
+        handler,
+        maxsize=1000,
+        drop_policy="block",
+        idle_handler=None,
+        idle_interval=1.0,
+        on_error=None,
+    ):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError("unknown drop policy " + drop_policy)
+        self.name = name
+        self.handler = handler
+        self.drop_policy = drop_policy
+        self.idle_handler = idle_handler
+        self.idle_interval = idle_interval
+        self.on_error = on_error
+        self.outputs = []
+
+        # Counters
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(
+            target=self._run, name=name, daemon=True
+        )
+
+    def connect(self, stage):
+        """
+        Pass the results of this stage on to stage
+        """
+        self.outputs.append(stage)
+        return stage
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Process the items already queued, then stop the worker. A stage that
+        was never started keeps its items.
+        """
+        if self._thread.ident is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def put(self, item):
+        """
+        Queue an item, following the drop policy if the queue is full
+
+        A stage that is not started yet never blocks, since nothing takes
+        items out of it. It drops its oldest items instead.
+        """
+        self.received += 1
+        drop_policy = self.drop_policy
+        if drop_policy == "block" and self._thread.ident is None:
+            drop_policy = "drop-oldest"
+        if drop_policy == "block":
+            self._queue.put(item)
+        elif drop_policy == "drop-newest":
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+        depth = self._queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def stats(self):
+        """
+        Get the counters and current queue depth of the stage
+        """
+        return {
+            "stage": self.name,
+            "depth": self._queue.qsize(),
+            "max_depth": self.max_depth,
+            "received": self.received,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle_interval)
+            except queue.Empty:
+                if self.idle_handler is not None:
+                    self._call(self.idle_handler)
+                continue
+            if item is _STOP:
+                break
+            result = self._call(self.handler, item)
+            self.processed += 1
+            if result is not None:
+                for stage in self.outputs:
+                    stage.put(result)
+        if self.idle_handler is not None:
+            self._call(self.idle_handler)
+
+    def _call(self, function, *args):
+        try:
+            return function(*args)
+        except Exception as e:
+            self.errors += 1
+            if self.on_error is not None:
+                self.on_error(e)
+            return None
+
+
+def format_stats(stages):
+    """
+    Format the counters of stages as one line per stage
+    """
+    return "\n".join(
+        "%(stage)-8s depth %(depth)5d (max %(max_depth)5d)  "
+        "received %(received)8d  processed %(processed)8d  "
+        "dropped %(dropped)6d  errors %(errors)4d" % stage.stats()
+        for stage in stages
+    )
@@ -0,0 +1,241 @@
+"""
+Streaming resampler for formatted csv files
+
+Readings are averaged per step (1 minute), interpolated linearly between the
+steps and averaged again per interval (10 minutes), like
+analyze_data.get_interpolated_pressure does for a single file. The files are
+read one day at a time and the interpolation carries over from one day to
+the next, so only a day of readings is in memory at a time.
+
+To resample pressure and flow of a location into one file:
+$ python resampler.py resample ../../data/2021/ out.csv -l loc-1
+"""
+
+import click
+import os
+import pandas as pd
+import re
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+###############################################################################
+# Global variables
+###############################################################################
+
+FORMATTED_COLUMNS = [
+    "Time",
+    "Flow 1 [m^3]",
+    "Flow 2 [m^3]",
+    "Temp [C]",
+    "Diff 1 [L]",
+    "Diff 2 [L]",
+    "Press Min [bar]",
+    "Press Max [bar]",
+    "Press Inst [bar]",
+    "RSSI [1-255]",
+]
+
+FORMATTED_FILE_PATTERN = re.compile(
+    r"^(?:(.+)_)?(\d{4}-\d{2}-\d{2})-formatted\.csv$"
+)
+
+
+###############################################################################
+# Main function
+###############################################################################
+@click.group()
+def main():
+    """
+    Streaming resampler for formatted csv files
+    """
+    pass
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+class StreamingResampler:
+    """
+    Resample time-ordered chunks of readings to a fixed interval
+
+    feed() returns the intervals that later chunks can no longer change.
+    An interval is held back while a column still waits for the next reading
+    to interpolate towards, so memory is bounded by the longest gap in a
+    column rather than the length of the data.
+    """
+
+    def __init__(self, columns, interval="10min", step="1min"):
+        self.columns = list(columns)
+        self.interval = pd.Timedelta(interval)
+        self.step = pd.Timedelta(step)
+        self._partial = None
+        self._steps = None
+        self._next_step = None
+        self._returned = None
+
+    def feed(self, chunk):
+        """
+        Add a chunk of readings indexed by time, later than all earlier
+        chunks, and get the finished intervals
+        """
+        rows = chunk[self.columns]
+        if self._partial is not None:
+            rows = pd.concat([self._partial, rows])
+        if rows.empty:
+            return self._empty()
+        # More readings for the last step may come in the next chunk
+        complete = rows.index < rows.index[-1].floor(self.step)
+        self._partial = rows[~complete]
+        return self._add_rows(rows[complete], False)
+
+    def finish(self):
+        """
+        Get the remaining intervals after the last chunk
+        """
+        rows = self._partial
+        self._partial = None
+        if rows is None:
+            rows = pd.DataFrame(columns=self.columns)
+        return self._add_rows(rows, True)
+
+    def _empty(self):
+        df = pd.DataFrame(columns=self.columns, dtype=float)
+        df.index = pd.DatetimeIndex([], name="Time")
+        return df
+
+    def _add_rows(self, rows, final):
+        if not rows.empty:
+            means = rows.groupby(rows.index.floor(self.step)).mean()
+            start = means.index[0]
+            if self._next_step is not None:
+                start = self._next_step
+            self._next_step = means.index[-1] + self.step
+            means = means.reindex(
+                pd.date_range(start, means.index[-1], freq=self.step)
+            )
+            if self._steps is not None:
+                means = pd.concat([self._steps, means])
+            self._steps = means.interpolate(limit_area="inside")
+        if self._steps is None:
+            return self._empty()
+
+        steps = self._steps
+        # The last reading of every column is kept to interpolate from
+        keep = self._next_step
+        if final:
+            # Like interpolate(), the last reading is held to the end
+            steps = steps.ffill()
+            cut = self._next_step + self.interval
+        else:
+            # A column is settled up to its last reading, or everywhere if
+            # it has had no readings yet
+            cut = self._next_step
+            for column in self.columns:
+                last_valid = steps[column].last_valid_index()
+                if last_valid is not None:
+                    cut = min(cut, last_valid + self.step)
+                    keep = min(keep, last_valid)
+        cut = cut.floor(self.interval)
+
+        done = steps.index < cut
+        self._steps = steps[steps.index >= min(keep, cut)]
+        # Steps kept for their readings were returned with their interval
+        if self._returned is not None:
+            done &= steps.index >= self._returned
+        self._returned = max(cut, self._returned or cut)
+        finished = steps[done]
+        finished = finished.groupby(finished.index.floor(self.interval)).mean()
+        finished.index.name = "Time"
+        return finished
+
+
+def resample_frame(df, columns, interval="10min", step="1min"):
+    """
+    Resample the columns of a DataFrame indexed by time
+    """
+    resampler = StreamingResampler(columns, interval, step)
+    return pd.concat(
+        [resampler.feed(df.sort_index(kind="stable")), resampler.finish()]
+    )
+
+
+def find_formatted_files(source, location=None):
+    """
+    Find all "[<location>_]<date>-formatted.csv" files below source, as a
+    date-sorted list of (date, path)
+    """
+    formatted_files = []
+    for dirpath, _, filenames in os.walk(source):
+        for filename in filenames:
+            match = FORMATTED_FILE_PATTERN.match(filename)
+            if match and match.group(1) == location:
+                formatted_files.append(
+                    (match.group(2), os.path.join(dirpath, filename))
+                )
+    formatted_files.sort()
+    return formatted_files
+
+
+def read_formatted_day(path, date, columns=None):
+    """
+    Read the columns of a formatted file, with or without a header line, as
+    a DataFrame indexed by time in order. All columns are read if columns is
+    None.
+    """
+    if columns is None:
+        columns = FORMATTED_COLUMNS[1:]
+    with open(path) as f:
+        has_header = f.readline().startswith("Time")
+    df = pd.read_csv(
+        path,
+        delimiter=";",
+        header=None,
+        names=FORMATTED_COLUMNS,
+        usecols=["Time"] + list(columns),
+        skiprows=1 if has_header else 0,
+        dtype={"Time": str},
+    )
+    df.index = pd.to_datetime(
+        date + " " + df.pop("Time"), format="%Y-%m-%d %H:%M:%S"
+    )
+    df.index.name = "Time"
+    return df.sort_index(kind="stable")
+
+
+@main.command()
+@click.argument("source", type=click.Path(exists=True, file_okay=False))
+@click.argument("output", type=click.Path())
+@click.option("-l", "--location", help="Location prefix of the files")
+@click.option(
+    "-c",
+    "--column",
+    "columns",
+    multiple=True,
+    default=["Press Inst [bar]", "Flow 1 [m^3]"],
+    show_default=True,
+)
+@click.option("-i", "--interval", default="10min", show_default=True)
+@click.option("-s", "--step", default="1min", show_default=True)
+@click.option("--start", help="First date, %Y-%m-%d")
+@click.option("--end", help="Last date, %Y-%m-%d")
+def resample(source, output, location, columns, interval, step, start, end):
+    """
+    Resample the formatted files below SOURCE into one csv file OUTPUT
+    """
+    resampler = StreamingResampler(columns, interval, step)
+    with open(output, "w", newline="") as f:
+        header = True
+        for date, path in find_formatted_files(source, location):
+            if (start and date < start) or (end and date > end):
+                continue
+            finished = resampler.feed(read_formatted_day(path, date, columns))
+            finished.to_csv(f, sep=";", header=header)
+            header = False
+            click.echo(path)
+        resampler.finish().to_csv(f, sep=";", header=header)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+Per-device rollups of the readings, kept up to date as packets arrive
+
+Every device gets one record per 1-minute, 10-minute and hourly interval,
+with the count of packets, min/max/mean pressure, the volume consumed in
+litres and min/max/mean RSSI. Records are fixed-width little-endian, one
+file per device, day and interval ("<device>-<date>-rollup-<interval>.bin")
+next to the raw files, and can be loaded as numpy structured arrays like
+the columnar store. An interval cut short by a restart of the logger can
+have two records, which are combined by weighting with the count.
+
+To compute the rollups of an archive of raw csv files:
+$ python rollups.py convert ../../data/2021/
+"""
+
+import click
+import csv
+import os
+import struct
+import time
+
+from columnar_store import find_raw_files, midnight_epoch, to_dataframe
+from mbus_decoder import format_frame, get_profile
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+###############################################################################
+# Global variables
+###############################################################################
+
+# Name and length in seconds of every rollup interval
+ROLLUP_INTERVALS = (("1min", 60), ("10min", 600), ("1h", 3600))
+
+# Fields of the rollup records, as numpy type strings. Pressures are NaN
+# for flow meters and the volume is 0 for pressure sensors.
+ROLLUP_FIELDS = [
+    ("time", "<i8"),
+    ("count", "<u4"),
+    ("press_min", "<f8"),
+    ("press_max", "<f8"),
+    ("press_mean", "<f8"),
+    ("volume", "<i8"),
+    ("rssi_min", "u1"),
+    ("rssi_max", "u1"),
+    ("rssi_mean", "<f4"),
+]
+ROLLUP_STRUCT = struct.Struct("<qIdddqBBf")
+
+NAN = float("nan")
+
+
+###############################################################################
+# Main function
+###############################################################################
+@click.group()
+def main():
+    """
+    Per-device rollups of the readings
+    """
+    pass
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+class RollupAggregator:
+    """
+    Keep the open interval of every device and rollup interval, and pack
+    its record once a packet from a later interval arrives
+
+    update() changes one running count, min, max and sum per interval, so
+    every packet costs the same however long the intervals are.
+    """
+
+    def __init__(self, intervals=ROLLUP_INTERVALS):
+        self.intervals = intervals
+        # (device, interval name) to [start, count, pressure min, pressure
+        # max, pressure sum, volume, RSSI min, RSSI max, RSSI sum]
+        self._buckets = {}
+
+    def update(self, device_name, sensor_type, epoch, formatted_packet):
+        """
+        Add a formatted packet received at epoch, and get the intervals it
+        closed as a list of (device, interval name, start, record)
+        """
+        fields = formatted_packet.split(";")
+        rssi = int(fields[9])
+        if sensor_type == "pressure":
+            press_min = float(fields[6])
+            press_max = float(fields[7])
+            press_inst = float(fields[8])
+            volume = 0
+        else:
+            volume = int(fields[4])
+
+        closed = []
+        for name, length in self.intervals:
+            start = epoch - epoch % length
+            bucket = self._buckets.get((device_name, name))
+            if bucket is None or bucket[0] != start:
+                if bucket is not None:
+                    closed.append(
+                        (device_name, name, bucket[0], pack_rollup(bucket))
+                    )
+                bucket = self._buckets[(device_name, name)] = [
+                    start,
+                    0,
+                    float("inf"),
+                    float("-inf"),
+                    0.0,
+                    0,
+                    255,
+                    0,
+                    0,
+                ]
+            bucket[1] += 1
+            if sensor_type == "pressure":
+                if press_min < bucket[2]:
+                    bucket[2] = press_min
+                if press_max > bucket[3]:
+                    bucket[3] = press_max
+                bucket[4] += press_inst
+            bucket[5] += volume
+            if rssi < bucket[6]:
+                bucket[6] = rssi
+            if rssi > bucket[7]:
+                bucket[7] = rssi
+            bucket[8] += rssi
+        return closed
+
+    def flush(self):
+        """
+        Get the records of all open intervals, and forget them
+        """
+        closed = [
+            (device_name, name, bucket[0], pack_rollup(bucket))
+            for (device_name, name), bucket in self._buckets.items()
+        ]
+        self._buckets.clear()
+        return closed
+
+
+def pack_rollup(bucket):
+    """
+    Pack an interval of RollupAggregator into a record
+    """
+    start, count, press_min, press_max, press_sum = bucket[:5]
+    if press_min > press_max:  # No pressure readings
+        press_min = press_max = press_mean = NAN
+    else:
+        press_mean = press_sum / count
+    return ROLLUP_STRUCT.pack(
+        start,
+        count,
+        press_min,
+        press_max,
+        press_mean,
+        bucket[5],
+        bucket[6],
+        bucket[7],
+        bucket[8] / count,
+    )
+
+
+def get_rollup_path(device_name, start, interval, directory=""):
+    """
+    Get the path of the rollup file of a device and interval for the day of
+    start, given in epoch seconds
+    """
+    date = time.strftime("%Y-%m-%d", time.gmtime(start))
+    return os.path.join(
+        directory, "%s-%s-rollup-%s.bin" % (device_name, date, interval)
+    )
+
+
+def load_rollups(directory, device_name, interval, dates):
+    """
+    Load the rollup records of a device and interval for a list of
+    "%Y-%m-%d" dates as a numpy structured array, skipping days without a
+    file. Use columnar_store.to_dataframe to get a DataFrame.
+    """
+    import numpy as np
+
+    dtype = np.dtype(ROLLUP_FIELDS)
+    arrays = []
+    for date in dates:
+        path = get_rollup_path(
+            device_name, midnight_epoch(date), interval, directory
+        )
+        if os.path.exists(path):
+            count = os.path.getsize(path) // dtype.itemsize
+            arrays.append(np.fromfile(path, dtype=dtype, count=count))
+    if not arrays:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(arrays)
+
+
+def get_flow_rate(records, interval):
+    """
+    Get the mean flow rate in L/s of every interval of flow meter rollups,
+    as a pandas Series indexed by time
+    """
+    length = dict(ROLLUP_INTERVALS)[interval]
+    return to_dataframe(records)["volume"] / length
+
+
+@main.command()
+@click.argument("source", type=click.Path(exists=True, file_okay=False))
+def convert(source):
+    """
+    Compute the rollups of the raw csv files below SOURCE and save them
+    next to the raw files
+    """
+    for device_name, days in sorted(find_raw_files(source).items()):
+        # Days are decoded in order, since decoding carries state from one
+        # packet to the next
+        aggregator = RollupAggregator()
+        # Records of an interval go next to the raw file of its day
+        directories = {
+            midnight_epoch(date): os.path.dirname(raw_path)
+            for date, raw_path in days
+        }
+        outputs = {}
+
+        def add(closed):
+            for _, name, start, record in closed:
+                directory = directories[start - start % 86400]
+                path = get_rollup_path(device_name, start, name, directory)
+                outputs.setdefault(path, []).append(record)
+
+        for date, raw_path in days:
+            with open(raw_path, newline="") as f:
+                for row in csv.reader(f):
+                    seconds, _, hex_frame = row[0].partition(";")
+                    frame = bytes.fromhex(hex_frame.replace(";", ""))
+                    formatted_packet = format_frame(frame, int(seconds))
+                    if formatted_packet is None:  # Unknown device
+                        continue
+                    add(
+                        aggregator.update(
+                            device_name,
+                            get_profile(frame).sensor_type,
+                            midnight_epoch(date) + int(seconds),
+                            formatted_packet,
+                        )
+                    )
+        add(aggregator.flush())
+        for path, records in sorted(outputs.items()):
+            with open(path, "wb") as f:
+                f.write(b"".join(records))
+            click.echo(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,36 @@ $ pip install -r requirements.txt
 """
 
 import click
-from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
 import serial
 import serial.tools.list_ports as list_ports
-import csv
 from datetime import datetime
-import time
 import json
+import threading
+import time
+import collections
+
+from cloud_upload import BatchPublisher
+from columnar_store import get_columnar_path, midnight_epoch, pack_record
+from dashboard import Dashboard
+from error_log import ErrorLog
+from file_sinks import SinkManager, exit_on_sigterm
+from frame_dedup import DuplicateFilter
+from frame_reader import FrameReader, get_device_name, hex_packet
+from mbus_decoder import (
+    format_frame,
+    get_profile,
+    get_upload_values,
+    load_device_profiles,
+    read_decoder_state,
+    save_decoder_state,
+    sensor_info_dict,
+    set_decoder_state,
+)
+from metrics import Callback, Counter, Histogram, registry, serve
+from pipeline import DROP_POLICIES, Stage, format_stats
+from rollups import RollupAggregator, get_rollup_path
+from upload_filter import DeadbandFilter
+from upload_spool import UploadSpool
 
 __author__ = "Christofer Gilje Skjaeveland"
 
@@ -26,20 +49,79 @@ rootCAPath = "root-CA.crt"
 privateKeyPath = "mbus-collector.private.key"
 certificatePath = "mbus-collector.cert.pem"
 
-# Keep dictionary of sensor specific variables
-# Prefixes are determined by VIF in M-Bus package
-# [location, last_min_pressure_VIF, last_max_pressure_VIF, last_inst_pressure_VIF
-# [location, last_flow1_VIF, last_flow2_VIF, last_temp_VIF, last_flow1_calc, last_flow2_calc]
-sensor_info_dict = {
-    "770004242c2d": ["loc-1", "69", "69", "69"],  # PressureSensor
-    "688268302c2d": ["loc-1", "13", "13", "67", -1, -1],  # flowIQ
-    "50902542ce9a": ["loc-2", "69", "69", "69"],  # Simulated PressureSensor
-    "51705369ce9a": ["loc-2", "13", "13", "67", -1, -1],  # Simulated flowIQ
-    "51705518ce9a": ["loc-3", "69", "69", "69"],  # Simulated PressureSensor
-    "51705538ce9a": ["loc-3", "13", "13", "67", -1, -1],  # Simulated flowIQ
-    "50902294ce9a": ["loc-4", "69", "69", "69"],  # Simulated PressureSensor
-    "51705516ce9a": ["loc-4", "13", "13", "67", -1, -1],  # Simulated flowIQ
-}
+# Errors of all threads, written as summaries to error_log.csv
+error_log = ErrorLog("error_log.csv")
+
+# Longest wait in seconds before reopening a port after an error
+MAX_RECONNECT_DELAY = 32
+
+# A frame on its way through the stages of log_port. The device profile
+# of the frame, None if it is unknown, decides how the packet is stored and
+# uploaded.
+Packet = collections.namedtuple(
+    "Packet",
+    [
+        "frame",
+        "device_name",
+        "seconds_since_midnight",
+        "date_today",
+        "formatted_packet",
+        "profile",
+    ],
+)
+
+# Metrics, served with --metrics-port
+errors_total = registry.register(
+    Counter("mbus_errors_total", "Errors in all threads", ["error"])
+)
+frames_received = registry.register(
+    Counter(
+        "mbus_frames_received_total",
+        "Frames read from all ports",
+        ["device"],
+    )
+)
+frames_decoded = registry.register(
+    Counter("mbus_frames_decoded_total", "Frames formatted", ["device"])
+)
+frames_rejected = registry.register(
+    Counter(
+        "mbus_frames_rejected_total",
+        "Frames from unknown devices or too short to format",
+        ["device"],
+    )
+)
+frames_duplicate = registry.register(
+    Counter(
+        "mbus_frames_duplicate_total",
+        "Repeated frames dropped before formatting",
+        ["device"],
+    )
+)
+decode_seconds = registry.register(
+    Histogram("mbus_decode_seconds", "Time to format a frame")
+)
+write_seconds = registry.register(
+    Histogram("mbus_write_seconds", "Time to save a packet to file")
+)
+publish_seconds = registry.register(
+    Histogram("mbus_publish_seconds", "Time to publish a message")
+)
+uploads_suppressed = registry.register(
+    Counter(
+        "mbus_uploads_suppressed_total",
+        "Readings not published because no value left the deadband",
+        ["sensor_type"],
+    )
+)
+rssi_histogram = registry.register(
+    Histogram(
+        "mbus_rssi",
+        "RSSI of received frames",
+        range(16, 256, 16),
+        ["device"],
+    )
+)
 
 
 ###############################################################################
@@ -48,7 +130,7 @@ sensor_info_dict = {
 @click.group()
 def main():
     """
-    Script for logging wM-Bus packets on a port
+    Script for logging wM-Bus packets on one or more ports
     """
     pass
 
@@ -68,427 +150,915 @@ def print_ports():
         click.echo(p)
 
 
-def calculate_pressure(VIF, D1, D2):
+def make_aws_client():
     """
-    Calculate pressure on M-bus format
+    Make the AWS IoT client, the AWS SDK is only imported when uploading
     """
-    # Extract bit 1 and 2 from hex number located at temp_pac[22]
-    prefix_bin = bin(int(VIF, 16))[2:].zfill(8)[6:9]
-    prefix = 10 ** (int(prefix_bin, 2) - 3)
-    hex_value = D1 + D2
-    dec_value = int(hex_value, 16) * prefix
-    return round(dec_value, 2)
+    from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
 
+    return AWSIoTMQTTClient(clientId)
 
-def calculate_volume(VIF, D1, D2, D3, D4):
+
+def init_aws_upload(myAWSIoTMQTTClient, offline_queue_size=-1):
     """
-    Calculate volume on M-bus format
+    Initialize AWS uploading
+
+    offline_queue_size is the number of messages the client queues in memory
+    while offline, -1 for no limit and 0 to fail publishing while offline.
     """
-    # Extract bit 1 and 2 from hex number located at temp_pac[23]
-    prefix_bin = bin(int(VIF, 16))[2:].zfill(8)[5:9]
-    prefix = 10 ** (int(prefix_bin, 2) - 6)
-    hex_value = D1 + D2 + D3 + D4
-    int_value = int(hex_value, 16) * prefix
-    return round(int_value, 3)
+    myAWSIoTMQTTClient.configureEndpoint(host, cloud_port)
+    myAWSIoTMQTTClient.configureCredentials(
+        rootCAPath, privateKeyPath, certificatePath
+    )
+
+    # AWSIoTMQTTClient connection configuration
+    myAWSIoTMQTTClient.configureAutoReconnectBackoffTime(1, 32, 20)
+    myAWSIoTMQTTClient.configureOfflinePublishQueueing(offline_queue_size)
+    myAWSIoTMQTTClient.configureDrainingFrequency(2)  # Draining: 2 Hz
+    myAWSIoTMQTTClient.configureConnectDisconnectTimeout(10)  # 10 sec
+    myAWSIoTMQTTClient.configureMQTTOperationTimeout(5)  # 5 sec
+
+    # Connect to AWS IoT
+    myAWSIoTMQTTClient.connect()
 
 
-def calculate_temperature(VIF, D1):
+def connect_in_background(offline_queue_size, on_connected):
     """
-    Calculate temperature on M-bus format
+    Make the AWS IoT client and connect it from a background thread, so the
+    ports are read from the start. Failed attempts are retried with a
+    growing delay. on_connected is called with the client once connected.
     """
-    # Extract bit 1 and 2 from hex number located at temp_pac[22]
-    prefix_bin = bin(int(VIF, 16))[2:].zfill(8)[6:9]
-    prefix = 10 ** (int(prefix_bin, 2) - 3)
-    hex_value = D1
-    # print("variables are ", str(hex_value), " and ", str(prefix))
-    int_value = int(hex_value, 16) * prefix
-    # print("returning ", str(int_value))
-    return int(int_value)
 
+    def connect():
+        backoff = 1
+        while True:
+            try:
+                myAWSIoTMQTTClient = make_aws_client()
+                init_aws_upload(myAWSIoTMQTTClient, offline_queue_size)
+                break
+            except Exception as e:
+                log_error(e, "connect")
+                time.sleep(backoff)
+                backoff = min(2 * backoff, 32)
+        on_connected(myAWSIoTMQTTClient)
 
-def calculate_pressure_packet(pac_list, i1, i2, i3):
-    device_name = (
-        pac_list[8]
-        + pac_list[7]
-        + pac_list[6]
-        + pac_list[5]
-        + pac_list[4]
-        + pac_list[3]
-    )
+    threading.Thread(target=connect, name="connect", daemon=True).start()
 
-    # [location, last_min_pressure_VIF, last_max_pressure_VIF, last_inst_pressure_VIF
-    global sensor_info_dict
-    last_min_pressure_VIF = sensor_info_dict[device_name][1]
-    last_max_pressure_VIF = sensor_info_dict[device_name][2]
-    last_inst_pressure_VIF = sensor_info_dict[device_name][3]
 
-    # Min pressure
-    press_min_calc = calculate_pressure(
-        last_min_pressure_VIF, pac_list[i1], pac_list[i1 - 1]
-    )
-    pressure_pac = ";;;;;;" + str(press_min_calc)
+class TimedClient:
+    """
+    Wrap an MQTT client to record how long every publish takes
+    """
 
-    # Max pressure
-    press_max_calc = calculate_pressure(
-        last_max_pressure_VIF, pac_list[i2], pac_list[i2 - 1]
-    )
-    pressure_pac += ";" + str(press_max_calc)
+    def __init__(self, client):
+        self.client = client
 
-    # Instant pressure
-    press_inst_calc = calculate_pressure(
-        last_inst_pressure_VIF, pac_list[i3], pac_list[i3 - 1]
-    )
-    pressure_pac += ";" + str(press_inst_calc)
-    return pressure_pac
-
-
-def calculate_flow_packet(pac_list, i1, i2, i3):
-    device_name = (
-        pac_list[8]
-        + pac_list[7]
-        + pac_list[6]
-        + pac_list[5]
-        + pac_list[4]
-        + pac_list[3]
-    )
-    # [location, last_flow1_VIF, last_flow2_VIF, last_temp_VIF, last_flow1_calc, last_flow2_calc]
-    global sensor_info_dict
-    last_flow1_VIF = sensor_info_dict[device_name][1]
-    last_flow2_VIF = sensor_info_dict[device_name][2]
-    last_temp_VIF = sensor_info_dict[device_name][3]
-    last_flow1_calc = sensor_info_dict[device_name][4]
-    last_flow2_calc = sensor_info_dict[device_name][5]
-    # flow 1
-    volume1_calc = calculate_volume(
-        last_flow1_VIF,
-        pac_list[i1],
-        pac_list[i1 - 1],
-        pac_list[i1 - 2],
-        pac_list[i1 - 3],
-    )
-    flow_pac = ";" + str(volume1_calc)
-
-    # flow 2
-    volume2_calc = calculate_volume(
-        last_flow2_VIF,
-        pac_list[i2],
-        pac_list[i2 - 1],
-        pac_list[i2 - 2],
-        pac_list[i2 - 3],
-    )
-    flow_pac += ";" + str(volume2_calc)
-
-    # temperature
-    # print("lets calculate som temperature with ", str(i3))
-    temp_calc = calculate_temperature(last_temp_VIF, pac_list[i3])
-    flow_pac += ";" + str(temp_calc)
-
-    # diff 1 & 2
-    if last_flow1_calc == -1:
-        flow_pac += ";" + "0"
-        flow_pac += ";" + "0"
-        sensor_info_dict[device_name][4] = volume1_calc
-        sensor_info_dict[device_name][5] = volume2_calc
-    else:
-        flow1_diff = int(1000 * volume1_calc) - int(1000 * last_flow1_calc)
-        flow2_diff = int(1000 * volume2_calc) - int(1000 * last_flow2_calc)
-        flow_pac += ";" + str(flow1_diff)
-        flow_pac += ";" + str(flow2_diff)
-        sensor_info_dict[device_name][4] = volume1_calc
-        sensor_info_dict[device_name][5] = volume2_calc
-    flow_pac += ";;;"
-    return flow_pac
-
-
-def format_packet(pac):
-    """
-    Format packets received on M-bus format into data that is readable
-    """
-    global sensor_info_dict
-
-    temp_pac = pac.split(";")
-    device_name = (
-        temp_pac[8]
-        + temp_pac[7]
-        + temp_pac[6]
-        + temp_pac[5]
-        + temp_pac[4]
-        + temp_pac[3]
-    )
+    def publish(self, topic, payload, qos):
+        start = time.perf_counter()
+        try:
+            return self.client.publish(topic, payload, qos)
+        finally:
+            publish_seconds.observe(time.perf_counter() - start)
 
-    new_pac = ""
 
-    # Time package was received
-    new_pac += time.strftime("%H:%M:%S", time.gmtime(int(temp_pac[0])))
+def register_logger_metrics(readers, stages, spool):
+    """
+    Register the metrics read from the ports, stages and upload spool when
+    the metrics are served
+    """
+    for name, key, help in (
+        ("mbus_bytes_read_total", "bytes_read", "Bytes read"),
+        ("mbus_frames_read_total", "frames_read", "Frames read"),
+        ("mbus_read_errors_total", "errors", "Errors reading the port"),
+        (
+            "mbus_resyncs_total",
+            "resyncs",
+            "Times the reader found the frames again after skipping bytes",
+        ),
+        (
+            "mbus_bytes_skipped_total",
+            "bytes_skipped",
+            "Bytes skipped to find the next frame header",
+        ),
+    ):
+        registry.register(
+            Callback(
+                name,
+                help,
+                lambda key=key: {
+                    port: reader.stats()[key]
+                    for port, reader in readers.items()
+                },
+                ["port"],
+                "counter",
+            )
+        )
+    for name, key, type, help in (
+        ("mbus_stage_queue_depth", "depth", "gauge", "Items queued"),
+        ("mbus_stage_dropped_total", "dropped", "counter", "Items dropped"),
+        ("mbus_stage_errors_total", "errors", "counter", "Handler errors"),
+    ):
+        registry.register(
+            Callback(
+                name,
+                help,
+                lambda key=key: {
+                    stage.name: stage.stats()[key] for stage in stages
+                },
+                ["stage"],
+                type,
+            )
+        )
+    if spool is not None:
+        registry.register(
+            Callback(
+                "mbus_offline_queue_depth",
+                "Messages in the upload spool waiting to be published",
+                spool.depth,
+            )
+        )
 
-    packet_type = temp_pac[10]
-    man_id_1 = temp_pac[3]
-    man_id_2 = temp_pac[4]
 
-    if (
-        man_id_1 == "2d" and man_id_2 == "2c" and packet_type == "16"
-    ):  # Kamstrup flowIQ
-        if temp_pac[20] == "78":  # VIF is transmitted
-            # last_flow1_VIF
-            sensor_info_dict[device_name][1] = temp_pac[27]
-            # last_flow2_VIF
-            sensor_info_dict[device_name][2] = temp_pac[33]
-            # last_temp_VIF
-            sensor_info_dict[device_name][3] = temp_pac[39]
-            i1 = 31
-            i2 = 37
-            i3 = 40
-        elif temp_pac[20] == "79":  # VIF is not transmitted
-            i1 = 30
-            i2 = 34
-            i3 = 35
-        new_pac += calculate_flow_packet(temp_pac, i1, i2, i3)
-
-    elif (
-        man_id_1 == "2d" and man_id_2 == "2c" and packet_type == "18"
-    ):  # Kamstrup PressureSensor
-        if temp_pac[20] == "78":  # VIF is transmitted
-            # last_min_pressure_VIF
-            sensor_info_dict[device_name][1] = temp_pac[22]
-            # last_max_pressure_VIF
-            sensor_info_dict[device_name][2] = temp_pac[26]
-            # last_inst_pressure_VIF
-            sensor_info_dict[device_name][3] = temp_pac[30]
-            i1 = 24
-            i2 = 28
-            i3 = 32
-        elif temp_pac[20] == "79":  # VIF is not transmitted
-            i1 = 26
-            i2 = 28
-            i3 = 30
-        new_pac += calculate_pressure_packet(temp_pac, i1, i2, i3)
-
-    elif (
-        man_id_1 == "9a" and man_id_2 == "ce" and packet_type == "16"
-    ):  # Simulated flowIQ
-        i1 = 31
-        i2 = 35
-        i3 = 36
-        new_pac += calculate_flow_packet(temp_pac, i1, i2, i3)
-
-    elif (
-        man_id_1 == "9a" and man_id_2 == "ce" and packet_type == "18"
-    ):  # Simulated PressureSensor
-        i1 = 27
-        i2 = 29
-        i3 = 31
-        new_pac += calculate_pressure_packet(temp_pac, i1, i2, i3)
+class StateSnapshots:
+    """
+    Save the decoder state to path every interval seconds
 
-    else:
-        print("unknown packet")
+    save_if_due() is called from the format stage, the only thread that
+    changes the decoder state.
+    """
 
-    rssi_hex = str(pac[-2]) + str(pac[-1])
-    rssi_int = int(rssi_hex, 16)
-    new_pac += ";" + str(rssi_int)
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.last_save = time.monotonic()
 
-    return new_pac
+    def save_if_due(self):
+        if time.monotonic() - self.last_save >= self.interval:
+            self.save()
 
+    def save(self):
+        # A failed save is tried again after the next interval
+        self.last_save = time.monotonic()
+        save_decoder_state(self.path, datetime.today().strftime("%Y-%m-%d"))
 
-def init_aws_upload(myAWSIoTMQTTClient):
+
+def print_packet(packet):
     """
-    Initialize AWS uploading
+    Print a data packet
     """
-    myAWSIoTMQTTClient.configureEndpoint(host, cloud_port)
-    myAWSIoTMQTTClient.configureCredentials(
-        rootCAPath, privateKeyPath, certificatePath
+    print(packet.replace(";", "\t") + "\t ")
+
+
+def log_error(e, source=""):
+    """
+    Count an error in the error log, grouped by its type and source
+    """
+    errors_total.inc(type(e).__name__)
+    error_log.record(e, source)
+
+
+def read_port(reader, output):
+    """
+    Read frames from a port forever and put them in the output stage
+    together with the time they were read
+
+    After an error the port is closed and opened again, e.g. for a USB
+    adapter that was unplugged, waiting twice as long after every failed
+    attempt, up to MAX_RECONNECT_DELAY seconds.
+    """
+    delay = 1
+    while True:
+        try:
+            if not reader.ser.is_open:
+                reader.ser.open()
+            frames = reader.read_frames()
+
+            # Time and date calculation, shared by all frames in the read
+            date_today = datetime.today().strftime("%Y-%m-%d")
+            now = datetime.now()
+            seconds_since_midnight = int(
+                (
+                    now
+                    - now.replace(hour=0, minute=0, second=0, microsecond=0)
+                ).total_seconds()
+            )
+        except Exception as e:
+            log_error(e, reader.ser.port)
+            reader.ser.close()
+            time.sleep(delay)
+            delay = min(2 * delay, MAX_RECONNECT_DELAY)
+            continue
+        delay = 1
+
+        for frame in frames:
+            frames_received.inc(get_device_name(frame))
+            output.put((frame, seconds_since_midnight, date_today))
+
+
+def drop_duplicate(duplicates, item):
+    """
+    Pass on a frame read by read_port, unless it was seen shortly before
+    """
+    frame = item[0]
+    if duplicates.is_duplicate(frame):
+        frames_duplicate.inc(get_device_name(frame))
+        return None
+    return item
+
+
+def process_frame(
+    item, print_raw_packets, format_packets, print_formatted_packets
+):
+    """
+    Print and format a frame read by read_port
+    """
+    frame, seconds_since_midnight, date_today = item
+    device_name = get_device_name(frame)
+
+    if print_raw_packets:
+        print_packet(str(seconds_since_midnight) + ";" + hex_packet(frame))
+
+    rssi_histogram.observe(frame[-1], device_name)
+
+    formatted_packet = None
+    if format_packets:
+        start = time.perf_counter()
+        formatted_packet = format_frame(frame, seconds_since_midnight)
+        decode_seconds.observe(time.perf_counter() - start)
+        if formatted_packet is None:
+            frames_rejected.inc(device_name)
+        else:
+            frames_decoded.inc(device_name)
+        if print_formatted_packets and formatted_packet is not None:
+            print_packet(device_name + ";" + formatted_packet)
+
+    return Packet(
+        frame,
+        device_name,
+        seconds_since_midnight,
+        date_today,
+        formatted_packet,
+        get_profile(frame),
     )
 
-    # AWSIoTMQTTClient connection configuration
-    myAWSIoTMQTTClient.configureAutoReconnectBackoffTime(1, 32, 20)
-    myAWSIoTMQTTClient.configureOfflinePublishQueueing(-1)  # Set as infinite
-    myAWSIoTMQTTClient.configureDrainingFrequency(2)  # Draining: 2 Hz
-    myAWSIoTMQTTClient.configureConnectDisconnectTimeout(10)  # 10 sec
-    myAWSIoTMQTTClient.configureMQTTOperationTimeout(5)  # 5 sec
 
-    # Connect to AWS IoT
-    myAWSIoTMQTTClient.connect()
+def write_rollups(sinks, closed, date_today):
+    """
+    Append the records of closed rollup intervals to their files
+    """
+    for device_name, interval, start, record in closed:
+        sinks.write_bytes(
+            get_rollup_path(device_name, start, interval), record, date_today
+        )
 
 
-def print_packet(packet):
+def store_packet(
+    sinks,
+    packet,
+    save_raw_packets,
+    save_formatted_packets,
+    save_columnar,
+    rollups=None,
+):
     """
-    Print a data packet
+    Save the raw and formatted packet to file, and add it to the rollups
+    """
+    start = time.perf_counter()
+    device_name = packet.device_name
+    date_today = packet.date_today
+
+    if save_raw_packets:
+        raw_save_loc = device_name + "-" + date_today + ".csv"
+        timed_packet = (
+            str(packet.seconds_since_midnight) + ";" + hex_packet(packet.frame)
+        )
+        sinks.write(raw_save_loc, timed_packet, date_today)
+
+    if save_formatted_packets and packet.formatted_packet is not None:
+        formatted_save_loc = (
+            sensor_info_dict[device_name][0]
+            + "_"
+            + date_today
+            + "-formatted.csv"
+        )
+        sinks.write(formatted_save_loc, packet.formatted_packet, date_today)
+
+    if save_columnar and packet.formatted_packet is not None:
+        sensor_type = packet.profile.sensor_type
+        sinks.write_bytes(
+            get_columnar_path(device_name, date_today, sensor_type),
+            pack_record(
+                sensor_type,
+                midnight_epoch(date_today) + packet.seconds_since_midnight,
+                packet.formatted_packet,
+            ),
+            date_today,
+        )
+
+    if rollups is not None and packet.formatted_packet is not None:
+        write_rollups(
+            sinks,
+            rollups.update(
+                device_name,
+                packet.profile.sensor_type,
+                midnight_epoch(date_today) + packet.seconds_since_midnight,
+                packet.formatted_packet,
+            ),
+            date_today,
+        )
+    write_seconds.observe(time.perf_counter() - start)
+
+
+def build_upload_data(packet):
+    """
+    Get the sensor type and data to be uploaded for a formatted packet, as
+    given by the device profile of its frame
+    """
+    device_name = packet.device_name
+    profile = packet.profile
+    if profile is None:
+        return "Unknown", {}
+
+    # Define data to be uploaded
+    data_to_upload = {
+        # "Date": date_today + " " + formatted_packet_list[0],
+        "SerialNumber": device_name,
+        "CollectorID": clientId,
+        "Location": sensor_info_dict[device_name][0],
+    }
+    data_to_upload.update(get_upload_values(profile, packet.formatted_packet))
+    data_to_upload["RSSI"] = int(packet.formatted_packet.rsplit(";", 1)[1])
+    return profile.sensor_type, data_to_upload
+
+
+def filter_upload(upload_filter, sensor_type, packet, data_to_upload):
+    """
+    Check if the upload data of a packet passes the deadband filter, if
+    there is one
+    """
+    if upload_filter is None:
+        return True
+    if upload_filter.check(sensor_type, packet.device_name, data_to_upload):
+        return True
+    uploads_suppressed.inc(sensor_type)
+    return False
+
+
+def upload_packet(myAWSIoTMQTTClient, packet, upload_filter=None):
+    """
+    Publish a formatted packet to the cloud
     """
-    packet_list = packet.split(";")
-    for i in packet_list:
-        print(i, end="\t")
-    print(" ")
+    if packet.formatted_packet is None:
+        return
+    sensor_type, data_to_upload = build_upload_data(packet)
+    if not filter_upload(upload_filter, sensor_type, packet, data_to_upload):
+        return
+
+    # Define topic name
+    topic = (
+        "collectors/" + clientId + "/" + sensor_type + "/" + packet.device_name
+    )
+    messageJson = json.dumps(data_to_upload)
+    try:
+        myAWSIoTMQTTClient.publish(topic, messageJson, 1)
+        # print('Published topic %s: %s\n' % (topic, messageJson))
+    except Exception as e:
+        log_error(e, "upload")
 
 
-def save_packet(save_loc, packet):
+def batch_packet(publisher, packet, upload_filter=None):
+    """
+    Add a formatted packet to the batch it is published with
     """
-    Save a data packet in a csv format
+    if packet.formatted_packet is None:
+        return
+    sensor_type, data_to_upload = build_upload_data(packet)
+    if not filter_upload(upload_filter, sensor_type, packet, data_to_upload):
+        return
+    data_to_upload["SensorType"] = sensor_type
+    data_to_upload["Date"] = (
+        packet.date_today + " " + packet.formatted_packet[:8]
+    )
+    publisher.add(sensor_type, data_to_upload)
+
+
+def format_dedup_stats(duplicates):
     """
-    with open(save_loc, "a", newline="") as f:
-        writer = csv.writer(f, delimiter=",")
-        writer.writerow([packet])
+    Format the counters of the duplicate filter as one line
+    """
+    return (
+        "dedup    checked %(checked)8d  duplicates %(duplicates)8d  "
+        "expired %(expired)8d  evicted %(evicted)6d  size %(size)6d"
+        % duplicates.stats()
+    )
+
+
+def format_upload_filter_stats(upload_filter):
+    """
+    Format the counters of the deadband filter as one line per sensor type
+    """
+    return "\n".join(
+        "%-8s devices %6d  published %8d  suppressed %8d  heartbeats %6d"
+        % (
+            sensor_type,
+            stats["devices"],
+            stats["published"],
+            stats["suppressed"],
+            stats["heartbeats"],
+        )
+        for sensor_type, stats in upload_filter.stats().items()
+    )
+
+
+def format_port_stats(readers):
+    """
+    Format the counters of the frame readers as one line per port
+    """
+    return "\n".join(
+        "%-16s bytes %12d  frames %8d  errors %4d  resyncs %6d  "
+        "skipped %8d"
+        % (
+            port,
+            stats["bytes_read"],
+            stats["frames_read"],
+            stats["errors"],
+            stats["resyncs"],
+            stats["bytes_skipped"],
+        )
+        for port, stats in (
+            (port, reader.stats()) for port, reader in readers.items()
+        )
+    )
 
 
 @main.command()
-@click.argument("port")
+@click.argument("ports", nargs=-1, required=True)
 @click.option("-pr", "--print-raw-packets", type=bool, default=True)
 @click.option("-sr", "--save-raw-packets", type=bool, default=True)
 @click.option("-f", "--format-packets", type=bool, default=False)
 @click.option("-pf", "--print-formatted-packets", type=bool, default=False)
 @click.option("-sf", "--save-formatted-packets", type=bool, default=False)
 @click.option("-u", "--upload-packets", type=bool, default=False)
+@click.option(
+    "-d",
+    "--dashboard",
+    type=bool,
+    default=False,
+    help="Show a table of the latest reading of every device instead of "
+    "printing packets",
+)
+@click.option(
+    "--refresh-rate",
+    type=float,
+    default=2.0,
+    help="Redraws of the dashboard per second",
+)
+@click.option(
+    "-sc",
+    "--save-columnar",
+    type=bool,
+    default=False,
+    help="Save formatted packets as binary records",
+)
+@click.option(
+    "-sro",
+    "--save-rollups",
+    type=bool,
+    default=False,
+    help="Save 1-minute, 10-minute and hourly rollups of every device",
+)
+@click.option(
+    "-dp",
+    "--device-profiles",
+    type=click.Path(exists=True),
+    help="JSON file with extra device profiles",
+)
+@click.option(
+    "--flush-bytes",
+    type=int,
+    default=65536,
+    help="Buffer size of each open file",
+)
+@click.option(
+    "--flush-interval",
+    type=float,
+    default=5.0,
+    help="Seconds between flushes of all open files",
+)
+@click.option(
+    "--fsync", type=bool, default=False, help="fsync files when flushing"
+)
+@click.option(
+    "--queue-size",
+    type=int,
+    default=1000,
+    help="Number of packets each stage can hold",
+)
+@click.option(
+    "--drop-policy",
+    type=click.Choice(DROP_POLICIES),
+    default="drop-oldest",
+    help="What the upload stage does with new packets when its queue is "
+    "full. The stages on the way to the files always block, so no packet "
+    "is lost to a slow disk.",
+)
+@click.option(
+    "--stats-interval",
+    type=float,
+    default=0,
+    help="Seconds between printing queue statistics, 0 to disable",
+)
+@click.option(
+    "--batch-window",
+    type=float,
+    default=0,
+    help="Seconds to gather readings into one upload, 0 to upload each",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=100,
+    help="Most readings in one batched upload",
+)
+@click.option(
+    "--batch-by",
+    type=click.Choice(["collector", "type"]),
+    default="collector",
+    help="Batch readings per collector or per sensor type",
+)
+@click.option(
+    "--batch-compress",
+    type=bool,
+    default=False,
+    help="zlib compress batched uploads",
+)
+@click.option(
+    "--upload-filter",
+    type=bool,
+    default=False,
+    help="Only upload readings that changed more than the deadband",
+)
+@click.option(
+    "--pressure-deadband",
+    type=float,
+    default=0.0,
+    help="Change in bar that uploads a pressure reading",
+)
+@click.option(
+    "--flow-deadband",
+    type=float,
+    default=0.0,
+    help="Change in m3 that uploads a flow reading",
+)
+@click.option(
+    "--heartbeat",
+    type=float,
+    default=900.0,
+    help="Seconds after which an unchanged reading is uploaded anyway",
+)
+@click.option(
+    "--spool-file",
+    default="upload_spool.db",
+    help="Database uploads are kept in until published, empty to keep "
+    "them in memory",
+)
+@click.option(
+    "--drain-rate",
+    type=click.FloatRange(min=0, min_open=True),
+    default=20.0,
+    help="Most messages published per second from the spool while catching "
+    "up after being offline",
+)
+@click.option(
+    "--state-file",
+    default="decoder_state.json",
+    help="File the decoder state is restored from and saved to, empty to "
+    "start from the defaults",
+)
+@click.option(
+    "--state-interval",
+    type=float,
+    default=60.0,
+    help="Seconds between saves of the decoder state",
+)
+@click.option(
+    "--error-interval",
+    type=float,
+    default=60.0,
+    help="Seconds between summaries of repeated errors in error_log.csv",
+)
+@click.option(
+    "--dedup-ttl",
+    type=float,
+    default=0,
+    help="Seconds a frame is remembered to drop its repeats, e.g. 5, or 0 "
+    "to keep all frames",
+)
+@click.option(
+    "--dedup-size",
+    type=int,
+    default=1024,
+    help="Most frames remembered to drop repeats",
+)
+@click.option(
+    "--metrics-port",
+    type=int,
+    default=0,
+    help="Port to serve Prometheus metrics on at /metrics, 0 to disable",
+)
+@click.option(
+    "--metrics-address",
+    default="127.0.0.1",
+    help="Address to serve metrics on",
+)
 def log_port(
-    port,
+    ports,
     print_raw_packets,
     save_raw_packets,
     format_packets,
     print_formatted_packets,
     save_formatted_packets,
     upload_packets,
+    dashboard,
+    refresh_rate,
+    save_columnar,
+    save_rollups,
+    device_profiles,
+    flush_bytes,
+    flush_interval,
+    fsync,
+    queue_size,
+    drop_policy,
+    stats_interval,
+    batch_window,
+    batch_size,
+    batch_by,
+    batch_compress,
+    upload_filter,
+    pressure_deadband,
+    flow_deadband,
+    heartbeat,
+    spool_file,
+    drain_rate,
+    state_file,
+    state_interval,
+    error_interval,
+    dedup_ttl,
+    dedup_size,
+    metrics_port,
+    metrics_address,
 ):
     """
-    Read serial port and choose between several options
+    Read one or more serial ports and choose between several options
+
+    Every port is read by its own thread, and formatting, saving and
+    uploading each run in a worker thread fed through a bounded queue, so a
+    slow disk or cloud connection does not stop the ports from being read.
+    All ports share the decoder state, the open files and the cloud
+    connection. Repeats of a frame, from the meter or from another port,
+    are dropped before formatting.
     """
-    if upload_packets or save_formatted_packets or print_formatted_packets:
+    if (
+        upload_packets
+        or save_formatted_packets
+        or print_formatted_packets
+        or save_columnar
+        or save_rollups
+        or dashboard
+    ):
         format_packets = True
 
-    myAWSIoTMQTTClient = None
-    myAWSIoTMQTTClient = AWSIoTMQTTClient(clientId)
-    init_aws_upload(myAWSIoTMQTTClient)
-
-    ser = serial.Serial(port, 19200)  # open serial port.
-    print(ser.name)
-    ser.reset_input_buffer()  # Discard all content of input buffer
-
-    while True:
+    # The dashboard replaces printing every packet
+    if dashboard:
+        print_raw_packets = False
+        print_formatted_packets = False
+
+    if device_profiles:
+        load_device_profiles(device_profiles)
+
+    # Continue the volume differences and VIFs from before a restart
+    snapshots = None
+    if state_file:
+        set_decoder_state(read_decoder_state(state_file)[1])
+        snapshots = StateSnapshots(state_file, state_interval)
+
+    # The cloud client is set once connected, see connect_in_background
+    timed_client = TimedClient(None)
+    spool = None
+    upload_client = timed_client
+    if upload_packets and spool_file:
+        spool = UploadSpool(
+            spool_file,
+            drain_rate,
+            on_error=lambda e: log_error(e, "upload"),
+        )
+        upload_client = spool
+
+    readers = {}
+    for port in ports:
+        ser = serial.Serial(port, 19200)  # open serial port.
+        print(ser.name)
+        ser.reset_input_buffer()  # Discard all content of input buffer
+        readers[port] = FrameReader(ser)
+
+    ###########################################################################
+    # Set up stages
+    ###########################################################################
+    stages = []
+
+    display = None
+    if dashboard:
+        display = Dashboard(refresh_rate, sensor_info_dict)
+
+    # The stages on the way to the files block when full, so only uploads
+    # follow the drop policy
+    duplicates = None
+    if dedup_ttl > 0:
+        duplicates = DuplicateFilter(dedup_ttl, dedup_size)
+        dedup_stage = Stage(
+            "dedup",
+            lambda item: drop_duplicate(duplicates, item),
+            queue_size,
+            "block",
+            on_error=log_error,
+        )
+        stages.append(dedup_stage)
+
+    def format_item(item):
         try:
-            ###################################################################
-            # Read all packets
-            ###################################################################
-            device_name = ""
-            ser_byte = ser.read()  # Read first byte to determine length
-            in_hex = ser_byte.hex()  # Convert to hex
-            packet = in_hex
-
-            # Read the rest of the bytes
-            for i in range(int(in_hex, 16)):
-                ser_byte = ser.read()
-                in_hex = ser_byte.hex()
-                packet += ";" + in_hex
-
-                if i <= 6 and i > 0:  # Store all bytes for device name
-                    device_name = in_hex + device_name
-
-            # Time and date calculation
-            date_today = datetime.today().strftime("%Y-%m-%d")
-            now = datetime.now()
-            seconds_since_midnight = int(
-                (
-                    now - now.replace(hour=0, minute=0, second=0, microsecond=0)
-                ).total_seconds()
+            packet = process_frame(
+                item,
+                print_raw_packets,
+                format_packets,
+                print_formatted_packets,
             )
-
-            timed_packet = str(seconds_since_midnight) + ";" + packet
-
-            ###################################################################
-            # Print raw Packets
-            ###################################################################
-            if print_raw_packets:
-                print_packet(timed_packet)
-
-            ###################################################################
-            # Format packets
-            ###################################################################
-            if format_packets:
-                formatted_packet = format_packet(timed_packet)
-
-            ###################################################################
-            # Print formatted packets
-            ###################################################################
-            if print_formatted_packets:
-                print_packet(device_name + ";" + formatted_packet)
-
-            ###################################################################
-            # Save raw packets to file
-            ###################################################################
-            if save_raw_packets:
-                raw_save_loc = device_name + "-" + date_today + ".csv"
-                save_packet(raw_save_loc, timed_packet)
-
-            ###################################################################
-            # Save formatted packets to file
-            ###################################################################
-            if save_formatted_packets:
-                formatted_save_loc = (
-                    sensor_info_dict[device_name][0]
-                    + "_"
-                    + date_today
-                    + "-formatted.csv"
-                )
-                save_packet(formatted_save_loc, formatted_packet)
-
-            ###################################################################
-            # Save formatted data to cloud
-            ###################################################################
-            if upload_packets:
-                formatted_packet_list = formatted_packet.split(";")
-                timed_packet_list = timed_packet.split(";")
-                sensor_type = "Unknown"
-                data_to_upload = {}
-
-                # Define data to be uploaded
-                if timed_packet_list[10] == "16":
-                    sensor_type = "flow"
-                    data_to_upload = {
-                        # "Date": date_today + " " + formatted_packet_list[0],
-                        "SerialNumber": device_name,
-                        "CollectorID": clientId,
-                        "Location": sensor_info_dict[device_name][0],
-                        "flow_inst": float(formatted_packet_list[1]),
-                        "flow_max_month": float(formatted_packet_list[2]),
-                        "temp_ambient": int(formatted_packet_list[3]),
-                        "flow_inst_diff": int(formatted_packet_list[4]),
-                        "flow_max_month_diff": int(formatted_packet_list[5]),
-                        "RSSI": int(formatted_packet_list[9]),
-                    }
-                elif timed_packet_list[10] == "18":
-                    sensor_type = "pressure"
-                    data_to_upload = {
-                        # "Date": date_today + " " + formatted_packet_list[0],
-                        "SerialNumber": device_name,
-                        "CollectorID": clientId,
-                        "Location": sensor_info_dict[device_name][0],
-                        "min_pressure": float(formatted_packet_list[6]),
-                        "max_pressure": float(formatted_packet_list[7]),
-                        "inst_pressure": float(formatted_packet_list[8]),
-                        "RSSI": int(formatted_packet_list[9]),
-                    }
-
-                # Define topic name
-                topic = (
-                    "collectors/"
-                    + clientId
-                    + "/"
-                    + sensor_type
-                    + "/"
-                    + device_name
-                )
-                messageJson = json.dumps(data_to_upload)
-                try:
-                    myAWSIoTMQTTClient.publish(topic, messageJson, 1)
-                    # print('Published topic %s: %s\n' % (topic, messageJson))
-                except Exception as e:
-                    print("Error: ", e)
-            ###################################################################
-
         except Exception as e:
-            error_time = datetime.today().strftime("%Y-%m-%d/%H:%M:%S")
-            print("Error occured at", error_time)
-            with open("error_log.csv", "a", newline="") as f:
-                writer = csv.writer(f, delimiter=",")
-                writer.writerow([error_time])
-                writer.writerow([e])
-            print("Continuing logging...")
-            continue
+            log_error(e, get_device_name(item[0]))
+            packet = None
+        if display is not None and packet is not None:
+            display.update(packet)
+        if snapshots is not None:
+            try:
+                snapshots.save_if_due()
+            except Exception as e:
+                log_error(e, "state")
+        return packet
+
+    format_stage = Stage(
+        "format",
+        format_item,
+        queue_size,
+        "block",
+        idle_handler=snapshots.save_if_due if snapshots else None,
+        on_error=log_error,
+    )
+    if duplicates is not None:
+        stages.append(dedup_stage.connect(format_stage))
+        input_stage = dedup_stage
+    else:
+        stages.append(format_stage)
+        input_stage = format_stage
+
+    # Keep files open between packets, and flush them on the way out
+    sinks = SinkManager(flush_bytes, flush_interval, fsync)
+    exit_on_sigterm()
+    rollups = RollupAggregator() if save_rollups else None
+    if (
+        save_raw_packets
+        or save_formatted_packets
+        or save_columnar
+        or save_rollups
+    ):
+        store_stage = Stage(
+            "store",
+            lambda packet: store_packet(
+                sinks,
+                packet,
+                save_raw_packets,
+                save_formatted_packets,
+                save_columnar,
+                rollups,
+            ),
+            queue_size,
+            "block",
+            idle_handler=sinks.flush_if_due,
+            on_error=log_error,
+        )
+        stages.append(format_stage.connect(store_stage))
+
+    publisher = None
+    upload_stage = None
+    deadband_filter = None
+    if upload_filter:
+        deadband_filter = DeadbandFilter(
+            {"pressure": pressure_deadband, "flow": flow_deadband}, heartbeat
+        )
+    if upload_packets and batch_window > 0:
+        publisher = BatchPublisher(
+            upload_client,
+            clientId,
+            batch_by,
+            batch_window,
+            batch_size,
+            batch_compress,
+            on_error=lambda e: log_error(e, "upload"),
+        )
+        upload_stage = Stage(
+            "upload",
+            lambda packet: batch_packet(publisher, packet, deadband_filter),
+            queue_size,
+            drop_policy,
+            idle_handler=publisher.flush_due,
+            on_error=log_error,
+        )
+        stages.append(format_stage.connect(upload_stage))
+    elif upload_packets:
+        upload_stage = Stage(
+            "upload",
+            lambda packet: upload_packet(
+                upload_client, packet, deadband_filter
+            ),
+            queue_size,
+            drop_policy,
+            on_error=log_error,
+        )
+        stages.append(format_stage.connect(upload_stage))
+
+    if metrics_port:
+        register_logger_metrics(readers, stages, spool)
+        serve(metrics_port, metrics_address)
+
+    # Without a spool, uploads wait in the upload stage until connected
+    waiting_stage = upload_stage if spool is None else None
+    for stage in stages:
+        if stage is not waiting_stage:
+            stage.start()
+    for port, reader in readers.items():
+        threading.Thread(
+            target=read_port,
+            args=(reader, input_stage),
+            name="read " + port,
+            daemon=True,
+        ).start()
+
+    connected = threading.Event()
+    if upload_packets:
+
+        def on_connected(myAWSIoTMQTTClient):
+            if spool is not None:
+                spool.start_draining(TimedClient(myAWSIoTMQTTClient))
+            else:
+                timed_client.client = myAWSIoTMQTTClient
+                upload_stage.start()
+            connected.set()
+
+        # The spool keeps the messages while offline instead of the client
+        connect_in_background(0 if spool is not None else -1, on_connected)
+
+    ###########################################################################
+    # Wait for Ctrl-C or SIGTERM
+    ###########################################################################
+    if display is not None:
+        display.start()
+    error_log.interval = error_interval
+    last_stats = time.monotonic()
+    try:
+        while True:
+            time.sleep(1.0)
+            error_log.flush_due()
+            if (
+                stats_interval > 0
+                and time.monotonic() - last_stats >= stats_interval
+            ):
+                last_stats = time.monotonic()
+                print(format_stats(stages))
+                print(format_port_stats(readers))
+                if duplicates is not None:
+                    print(format_dedup_stats(duplicates))
+                if deadband_filter is not None:
+                    print(format_upload_filter_stats(deadband_filter))
+    finally:
+        if display is not None:
+            display.stop()
+        # Finish the packets already read before closing the files
+        for stage in stages:
+            stage.stop()
+        if snapshots is not None:
+            snapshots.save()
+        if rollups is not None:
+            # The open intervals, completed by a second record after a
+            # restart
+            write_rollups(
+                sinks,
+                rollups.flush(),
+                datetime.today().strftime("%Y-%m-%d"),
+            )
+        sinks.close()
+        if publisher is not None and (spool is not None or connected.is_set()):
+            publisher.flush()
+        if spool is not None:
+            spool.stop()
+        error_log.close()
 
 
 if __name__ == "__main__":
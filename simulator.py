@@ -0,0 +1,355 @@
+"""
+wM-Bus receiver simulator on a pty
+
+Generated frames follow the registered device profiles, so the logger
+decodes them like frames from real meters. Both commands print the path of
+the port to pass to serial_logger.py log-port.
+
+To send frames from 8 meters at 20 frames per second in total:
+$ python simulator.py generate -m 8 -r 20
+
+To replay an archive of raw csv files 60 times faster than real time:
+$ python simulator.py replay ../../data/2021/05-may/ -s 60
+"""
+
+import click
+import heapq
+import os
+import random
+import struct
+import time
+import tty
+
+from columnar_store import find_raw_files, midnight_epoch
+from mbus_decoder import (
+    PRESSURE_SCALE,
+    VOLUME_SCALE,
+    device_profiles,
+    sensor_info_dict,
+)
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+###############################################################################
+# Global variables
+###############################################################################
+
+# Device types in the frame header
+DEVICE_TYPES = {"flow": 0x16, "pressure": 0x18}
+
+# CI fields of frames with and without VIFs
+CI_LONG = 0x78
+CI_SHORT = 0x79
+
+# Access number, counting the frames of a meter, so a repeated reading is
+# still a new frame
+ACCESS_NUMBER_OFFSET = 10
+
+# Length of the generated frames, including the L-field
+FRAME_LENGTH = 48
+
+# VIFs sent in long frames, the same as the defaults in sensor_info_dict
+FLOW_VIFS = (0x13, 0x13, 0x67)
+PRESSURE_VIFS = (0x69, 0x69, 0x69)
+
+
+###############################################################################
+# Main function
+###############################################################################
+@click.group()
+def main():
+    """
+    wM-Bus receiver simulator on a pty
+    """
+    pass
+
+
+###############################################################################
+# Functions
+###############################################################################
+
+
+class SimulatedMeter:
+    """
+    A meter that sends frames for its device profile, with a volume that
+    keeps growing or a pressure that wanders around 3 bar
+
+    Kamstrup meters send every long_every-th frame with VIFs, like the real
+    meters do.
+    """
+
+    def __init__(self, device_name, sensor_type, rng, long_every=10):
+        self.device_name = device_name
+        self.sensor_type = sensor_type
+        self.rng = rng
+        self.long_every = long_every
+        self.frames_sent = 0
+
+        device_id = bytes.fromhex(device_name)[::-1]
+        self._header = bytes([FRAME_LENGTH - 1, 0x44]) + device_id + b"\x01"
+        manufacturer = int.from_bytes(device_id[:2], "little")
+        device_type = DEVICE_TYPES[sensor_type]
+        self._profiles = {}
+        for ci_field in (CI_LONG, CI_SHORT):
+            profile = device_profiles.get(
+                (manufacturer, device_type, ci_field)
+            )
+            if profile is None:
+                profile = device_profiles.get(
+                    (manufacturer, device_type, None)
+                )
+            if profile is None:
+                raise ValueError("no device profile for " + device_name)
+            self._profiles[ci_field] = profile
+
+        self._volume = rng.uniform(100.0, 1000.0)
+        self._pressure = 3.0
+
+    def next_values(self):
+        """
+        Get the raw field values of the next frame
+        """
+        if self.sensor_type == "flow":
+            self._volume += self.rng.expovariate(100.0)
+            volume = int(self._volume / VOLUME_SCALE[FLOW_VIFS[0]])
+            return volume, volume, self.rng.randint(5, 25)
+        self._pressure += self.rng.gauss(0, 0.02)
+        self._pressure = min(max(self._pressure, 0.5), 10.0)
+        inst = int(self._pressure / PRESSURE_SCALE[PRESSURE_VIFS[0]])
+        spread = self.rng.randrange(0, 10)
+        return inst - spread, inst + spread, inst
+
+    def next_frame(self, rssi=None):
+        """
+        Get the next frame of the meter
+        """
+        if self.frames_sent % self.long_every == 0:
+            ci_field = CI_LONG
+        else:
+            ci_field = CI_SHORT
+        profile = self._profiles[ci_field]
+        self.frames_sent += 1
+
+        frame = bytearray(FRAME_LENGTH)
+        frame[: len(self._header)] = self._header
+        frame[9] = DEVICE_TYPES[self.sensor_type]
+        frame[ACCESS_NUMBER_OFFSET] = (self.frames_sent - 1) & 0xFF
+        frame[19] = ci_field
+        for (offset, field_format), value in zip(
+            profile.fields, self.next_values()
+        ):
+            struct.pack_into("<" + field_format, frame, offset, value)
+        if self.sensor_type == "flow":
+            vifs = FLOW_VIFS
+        else:
+            vifs = PRESSURE_VIFS
+        for offset, vif in zip(profile.vif_offsets, vifs):
+            frame[offset] = vif
+        if rssi is None:
+            rssi = self.rng.randint(150, 220)
+        frame[-1] = rssi
+        return bytes(frame)
+
+
+def make_meters(count, seed=0):
+    """
+    Make count meters, first the devices in sensor_info_dict and then extra
+    simulated devices, which the logger saves but does not format
+    """
+    rng = random.Random(seed)
+    meters = []
+    for device_name, sensor_info in sensor_info_dict.items():
+        sensor_type = "flow" if len(sensor_info) == 6 else "pressure"
+        meters.append(SimulatedMeter(device_name, sensor_type, rng))
+    for i in range(count - len(meters)):
+        sensor_type = ("flow", "pressure")[i % 2]
+        device_name = "%08d" % (90000000 + i) + "ce9a"
+        meters.append(SimulatedMeter(device_name, sensor_type, rng))
+    return meters[:count]
+
+
+def open_pty(link=None):
+    """
+    Open a pty pair in raw mode and return the master and slave fds
+
+    The slave stays open, so frames can be written before the logger opens
+    the port. link is an optional symlink to the port.
+    """
+    master_fd, slave_fd = os.openpty()
+    tty.setraw(slave_fd)
+    port = os.ttyname(slave_fd)
+    if link:
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(port, link)
+        port = link
+    click.echo(port)
+    return master_fd, slave_fd
+
+
+def send(master_fd, timed_frames):
+    """
+    Write frames to the master side of a pty at their time, given in
+    seconds from the start as (time, frame). Frames that are late are sent
+    at once.
+
+    Returns the number of frames and the seconds it took.
+    """
+    count = 0
+    start = time.perf_counter()
+    for send_time, frame in timed_frames:
+        delay = start + send_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        view = memoryview(frame)
+        while view:
+            view = view[os.write(master_fd, view) :]
+        count += 1
+    return count, time.perf_counter() - start
+
+
+def wait_for_interrupt():
+    """
+    Keep the port open, so the frames left in it can still be read, until
+    Ctrl-C
+    """
+    click.echo("Ctrl-C to close the port")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+def generate_frames(meters, rate, jitter, count, rng):
+    """
+    Generate (time, frame) with the meters sending in turn, rate frames per
+    second in total, every interval varied by up to +-jitter of itself
+    """
+    interval = 1.0 / rate if rate > 0 else 0.0
+    send_time = 0.0
+    sent = 0
+    while count <= 0 or sent < count:
+        meter = meters[sent % len(meters)]
+        yield send_time, meter.next_frame()
+        send_time += interval * (1 + rng.uniform(-jitter, jitter))
+        sent += 1
+
+
+def read_raw_file(path, epoch):
+    """
+    Read (epoch time, frame) from a raw csv file
+    """
+    with open(path) as f:
+        for line in f:
+            seconds, _, hex_frame = line.strip().partition(";")
+            if hex_frame:
+                yield (
+                    epoch + int(seconds),
+                    bytes.fromhex(hex_frame.replace(";", "")),
+                )
+
+
+def replay_frames(raw_files, speed):
+    """
+    Merge the frames of all raw files in time order, as (time, frame) with
+    the time in seconds from the first frame divided by speed
+    """
+    days = {}
+    for device_days in raw_files.values():
+        for date, path in device_days:
+            days.setdefault(date, []).append(path)
+    first = None
+    for date in sorted(days):
+        epoch = midnight_epoch(date)
+        # One day of every device at a time, each file is in time order
+        for frame_time, frame in heapq.merge(
+            *[read_raw_file(path, epoch) for path in days[date]],
+            key=lambda timed_frame: timed_frame[0],
+        ):
+            if first is None:
+                first = frame_time
+            if speed > 0:
+                yield (frame_time - first) / speed, frame
+            else:
+                yield 0.0, frame
+
+
+@main.command()
+@click.option("-m", "--meters", type=int, default=8, show_default=True)
+@click.option(
+    "-r",
+    "--rate",
+    type=float,
+    default=10.0,
+    show_default=True,
+    help="Frames per second from all meters, 0 for as fast as possible",
+)
+@click.option(
+    "-j",
+    "--jitter",
+    type=float,
+    default=0.2,
+    show_default=True,
+    help="Largest change of the interval between frames, as a fraction",
+)
+@click.option(
+    "-n", "--count", type=int, default=0, help="Frames to send, 0 for no end"
+)
+@click.option("-l", "--link", help="Symlink to create to the port")
+@click.option("--seed", type=int, default=0)
+def generate(meters, rate, jitter, count, link, seed):
+    """
+    Send frames from simulated meters
+    """
+    master_fd, slave_fd = open_pty(link)
+    rng = random.Random(seed)
+    frames = generate_frames(
+        make_meters(meters, seed), rate, jitter, count, rng
+    )
+    try:
+        sent, elapsed = send(master_fd, frames)
+        click.echo("%d frames in %.1f s" % (sent, elapsed))
+        wait_for_interrupt()
+    finally:
+        os.close(slave_fd)
+        os.close(master_fd)
+
+
+@main.command()
+@click.argument(
+    "sources",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option(
+    "-s",
+    "--speed",
+    type=float,
+    default=1.0,
+    show_default=True,
+    help="Times faster than real time, 0 for as fast as possible",
+)
+@click.option("-l", "--link", help="Symlink to create to the port")
+def replay(sources, speed, link):
+    """
+    Send the frames of the raw "<device>-<date>.csv" files below SOURCES in
+    the order they were received
+    """
+    raw_files = {}
+    for source in sources:
+        for device_name, days in find_raw_files(source).items():
+            raw_files.setdefault(device_name, []).extend(days)
+    master_fd, slave_fd = open_pty(link)
+    try:
+        sent, elapsed = send(master_fd, replay_frames(raw_files, speed))
+        click.echo("%d frames in %.1f s" % (sent, elapsed))
+        wait_for_interrupt()
+    finally:
+        os.close(slave_fd)
+        os.close(master_fd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Expiry and eviction of the duplicate filter, with a stand-in clock
+"""
+
+from frame_dedup import DuplicateFilter
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def frame(number, rssi=0x80):
+    return bytes([number, 0x44, 0x2D, 0x2C, 1, 2, 3, 4, rssi])
+
+
+def test_copies_are_dropped_until_ttl():
+    clock = Clock()
+    duplicates = DuplicateFilter(ttl=5.0, clock=clock)
+    assert not duplicates.is_duplicate(frame(1))
+    clock.now = 1.0
+    # Heard by another receiver, with another RSSI
+    assert duplicates.is_duplicate(frame(1, rssi=0x90))
+    assert not duplicates.is_duplicate(frame(2))
+    clock.now = 5.0
+    assert not duplicates.is_duplicate(frame(1))
+    assert duplicates.is_duplicate(frame(2))
+    assert duplicates.stats() == {
+        "checked": 5,
+        "duplicates": 2,
+        "expired": 1,
+        "evicted": 0,
+        "size": 2,
+    }
+
+
+def test_least_recently_seen_is_evicted():
+    clock = Clock()
+    duplicates = DuplicateFilter(ttl=60.0, maxsize=3, clock=clock)
+    for number in (1, 2, 3):
+        assert not duplicates.is_duplicate(frame(number))
+    # 1 repeats and is kept, 2 is the least recently seen
+    assert duplicates.is_duplicate(frame(1))
+    assert not duplicates.is_duplicate(frame(4))
+    assert duplicates.is_duplicate(frame(1))
+    assert not duplicates.is_duplicate(frame(2))
+    assert duplicates.stats()["evicted"] == 2
+
+
+def test_repeats_do_not_extend_ttl():
+    clock = Clock()
+    duplicates = DuplicateFilter(ttl=5.0, clock=clock)
+    assert not duplicates.is_duplicate(frame(1))
+    clock.now = 1.0
+    assert not duplicates.is_duplicate(frame(2))
+    clock.now = 4.0
+    assert duplicates.is_duplicate(frame(1))
+    # 1 has expired, though 2 was seen less recently
+    clock.now = 5.5
+    assert not duplicates.is_duplicate(frame(1))
+    assert duplicates.is_duplicate(frame(2))
@@ -0,0 +1,83 @@
+"""
+Split a noisy byte stream into frames, read in chunks of different sizes
+"""
+
+import random
+
+import pytest
+
+from frame_reader import FrameReader
+from simulator import make_meters
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+
+class ChunkedPort:
+    """
+    Serial port giving the bytes of data in chunks of at most chunk_size
+    """
+
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.position = 0
+
+    @property
+    def in_waiting(self):
+        return min(len(self.data) - self.position, self.chunk_size)
+
+    def read(self, size):
+        chunk = self.data[self.position : self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+
+def make_stream(count, seed=0):
+    """
+    Get count frames and a byte stream of them with noise between some
+    frames and some frames cut short
+    """
+    rng = random.Random(seed)
+    meters = make_meters(8)
+    frames = [rng.choice(meters).next_frame() for _ in range(count)]
+    stream = bytearray()
+    for frame in frames:
+        if rng.random() < 0.05:
+            stream += bytes(
+                rng.randrange(256) for _ in range(rng.randint(1, 8))
+            )
+        if rng.random() < 0.02:
+            stream += bytes(rng.randint(1, 20))
+        if rng.random() < 0.02:
+            frame = frame[: rng.randint(1, len(frame) - 1)]
+        stream += frame
+    return frames, bytes(stream)
+
+
+def read_all(data, chunk_size):
+    port = ChunkedPort(data, chunk_size)
+    reader = FrameReader(port)
+    frames = []
+    while port.position < len(data):
+        frames += reader.read_frames()
+    return frames, reader.stats()
+
+
+def test_clean_stream():
+    frames = [meter.next_frame() for meter in make_meters(8) * 10]
+    result, stats = read_all(b"".join(frames), 100)
+    assert result == frames
+    assert stats["resyncs"] == 0
+    assert stats["bytes_skipped"] == 0
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 48, 333, 4096])
+def test_resync_does_not_depend_on_chunk_size(chunk_size):
+    frames, data = make_stream(2000)
+    expected, expected_stats = read_all(data, len(data))
+    result, stats = read_all(data, chunk_size)
+    assert result == expected
+    assert stats == expected_stats
+    # Frames after noise are found again
+    assert len(set(result) & set(frames)) > 0.95 * len(frames)
+    assert 0 < stats["resyncs"] <= stats["bytes_skipped"]
@@ -0,0 +1,186 @@
+"""
+Decode frames through the scale tables and device profiles
+"""
+
+import json
+import struct
+
+import pytest
+
+import mbus_decoder
+from mbus_decoder import (
+    calculate_pressure,
+    calculate_temperature,
+    calculate_volume,
+    format_frame,
+    get_profile,
+    get_upload_values,
+    load_device_profiles,
+    make_profile,
+)
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+FLOW_METER = "688268302c2d"
+PRESSURE_SENSOR = "770004242c2d"
+
+
+def make_frame(device_name, device_type, ci_field, fields, length=48):
+    """
+    Make a frame with the given (offset, struct format, value) fields, and
+    an RSSI of 0x90
+    """
+    frame = bytearray(length)
+    frame[0] = length - 1
+    frame[1] = 0x44
+    frame[2:8] = bytes.fromhex(device_name)[::-1]
+    frame[9] = device_type
+    frame[19] = ci_field
+    for offset, field_format, value in fields:
+        struct.pack_into("<" + field_format, frame, offset, value)
+    frame[-1] = 0x90
+    return bytes(frame)
+
+
+@pytest.fixture(autouse=True)
+def sensor_info(monkeypatch):
+    """
+    Start every test from the default decoder state of the test devices
+    """
+    monkeypatch.setitem(
+        mbus_decoder.sensor_info_dict,
+        FLOW_METER,
+        ["loc-1", 0x13, 0x13, 0x67, -1, -1],
+    )
+    monkeypatch.setitem(
+        mbus_decoder.sensor_info_dict,
+        PRESSURE_SENSOR,
+        ["loc-1", 0x69, 0x69, 0x69],
+    )
+
+
+def test_scale_tables():
+    # The exponent is in the lowest bits of the VIF
+    for vif in range(256):
+        assert calculate_pressure(vif, 1234) == round(
+            1234 * 10 ** ((vif & 0x03) - 3), 2
+        )
+        assert calculate_volume(vif, 123456) == round(
+            123456 * 10 ** ((vif & 0x07) - 6), 3
+        )
+    assert calculate_pressure(0x69, 1234) == 12.34
+    assert calculate_volume(0x13, 123456789) == 123456.789
+    assert calculate_temperature(0x67, 21) == 21
+
+
+def test_flow_frames():
+    long_frame = make_frame(
+        FLOW_METER,
+        0x16,
+        0x78,
+        [
+            (26, "B", 0x13),
+            (27, "I", 123456),
+            (32, "B", 0x14),
+            (33, "I", 5000),
+            (38, "B", 0x67),
+            (39, "B", 21),
+        ],
+    )
+    assert (
+        format_frame(long_frame, 100) == "00:01:40;123.456;50.0;21;0;0;;;;144"
+    )
+    # Short frames use the VIFs of the last long frame
+    short_frame = make_frame(
+        FLOW_METER,
+        0x16,
+        0x79,
+        [(26, "I", 123466), (30, "I", 5010), (34, "B", 22)],
+    )
+    assert (
+        format_frame(short_frame, 3661)
+        == "01:01:01;123.466;50.1;22;10;100;;;;144"
+    )
+
+
+def test_pressure_frames():
+    long_frame = make_frame(
+        PRESSURE_SENSOR,
+        0x18,
+        0x78,
+        [
+            (21, "B", 0x69),
+            (22, "H", 350),
+            (25, "B", 0x69),
+            (26, "H", 420),
+            (29, "B", 0x6A),
+            (30, "H", 400),
+        ],
+    )
+    assert format_frame(long_frame, 0) == "00:00:00;;;;;;3.5;4.2;40.0;144"
+    short_frame = make_frame(
+        PRESSURE_SENSOR,
+        0x18,
+        0x79,
+        [(24, "H", 351), (26, "H", 421), (28, "H", 401)],
+    )
+    assert format_frame(short_frame, 0) == "00:00:00;;;;;;3.51;4.21;40.1;144"
+
+
+def test_rejected_frames():
+    fields = [(26, "I", 1), (30, "I", 2), (34, "B", 3)]
+    # Unknown CI field, unknown device and too short for the profile
+    assert format_frame(make_frame(FLOW_METER, 0x16, 0x7A, fields), 0) is None
+    assert (
+        format_frame(make_frame("123456782c2d", 0x16, 0x79, fields), 0) is None
+    )
+    assert (
+        format_frame(make_frame(FLOW_METER, 0x16, 0x79, [], length=30), 0)
+        is None
+    )
+
+
+def test_profile_offsets():
+    profile = make_profile(
+        "Test", "flow", [(27, "I"), (33, "I"), (39, "B")], (26, 32, 38)
+    )
+    assert profile.layout.format == "<27xI2xI2xB"
+    assert profile.vif_layout.format == "<26xB5xB5xB"
+    # The RSSI byte follows the last field
+    assert profile.min_length == 41
+    with pytest.raises(ValueError):
+        make_profile("Overlap", "flow", [(27, "I"), (29, "I"), (35, "B")])
+    with pytest.raises(ValueError):
+        make_profile("Unknown", "water", [(27, "I"), (31, "I"), (35, "B")])
+
+
+def test_load_device_profiles(monkeypatch, tmp_path):
+    monkeypatch.setattr(mbus_decoder, "device_profiles", {})
+    path = tmp_path / "profiles.json"
+    path.write_text(
+        json.dumps(
+            [
+                {
+                    "name": "Water meter",
+                    "manufacturer": "2c2d",
+                    "device_type": "07",
+                    "sensor_type": "flow",
+                    "fields": [[26, "I"], [30, "I"], [34, "B"]],
+                    "upload_fields": [["volume", 1, "float"]],
+                }
+            ]
+        )
+    )
+    load_device_profiles(str(path))
+    frame = make_frame(
+        FLOW_METER,
+        0x07,
+        0x7A,
+        [(26, "I", 123456), (30, "I", 5000), (34, "B", 21)],
+    )
+    # No CI field in the profile matches any
+    profile = get_profile(frame)
+    assert profile.name == "Water meter"
+    formatted_packet = format_frame(frame, 0)
+    assert formatted_packet == "00:00:00;123.456;5.0;21;0;0;;;;144"
+    assert get_upload_values(profile, formatted_packet) == {"volume": 123.456}
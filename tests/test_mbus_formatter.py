@@ -0,0 +1,89 @@
+"""
+Compare the batch decoder of mbus_formatter with formatting one by one
+"""
+
+import random
+import struct
+
+import pytest
+
+import mbus_decoder
+from frame_reader import hex_packet
+from mbus_decoder import get_decoder_state, make_profile, set_decoder_state
+from mbus_formatter import format_packets, format_packets_batch
+from simulator import make_meters
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+
+def format_both(packets):
+    """
+    Format packets one by one and in batch, from the same decoder state
+    """
+    state = get_decoder_state()
+    expected = format_packets(packets)
+    set_decoder_state(state)
+    result = format_packets_batch(packets)
+    set_decoder_state(state)
+    return expected, result
+
+
+def make_packets(frames, rng):
+    times = sorted(rng.randrange(86400) for _ in frames)
+    return ["%d;%s" % (t, hex_packet(f)) for t, f in zip(times, frames)]
+
+
+def test_batch_matches_format_packets():
+    rng = random.Random(0)
+    meters = make_meters(8)
+    frames = [rng.choice(meters).next_frame() for _ in range(500)]
+    # An unknown device and a frame too short for a header
+    frames.append(bytes.fromhex("2f442d2c78563412011600") + bytes(37))
+    frames.append(bytes(12))
+    expected, result = format_both(make_packets(frames, rng))
+    assert len(expected) == 500
+    assert result == expected
+
+
+@pytest.mark.parametrize(
+    "sensor_type, fields",
+    [
+        ("pressure", [(25, "h"), (27, "h"), (29, "h")]),
+        ("flow", [(25, "i"), (29, "i"), (33, "b")]),
+    ],
+)
+def test_signed_fields(monkeypatch, sensor_type, fields):
+    monkeypatch.setitem(
+        mbus_decoder.device_profiles,
+        (mbus_decoder.SIMULATED, 0x30, None),
+        make_profile("Signed", sensor_type, fields),
+    )
+    info = ["loc-9", 0x69, 0x69, 0x69]
+    if sensor_type == "flow":
+        info = ["loc-9", 0x13, 0x13, 0x67, -1, -1]
+    monkeypatch.setitem(mbus_decoder.sensor_info_dict, "12345678ce9a", info)
+
+    rng = random.Random(1)
+    frames = []
+    for _ in range(300):
+        frame = bytearray(40)
+        frame[0] = len(frame) - 1
+        frame[1] = 0x44
+        frame[2:8] = struct.pack("<HI", mbus_decoder.SIMULATED, 0x12345678)
+        frame[9] = 0x30
+        frame[19] = 0x7A
+        for offset, field_format in fields:
+            bits = 8 * struct.calcsize(field_format)
+            value = rng.randrange(-(2 ** (bits - 1)), 2 ** (bits - 1))
+            struct.pack_into("<" + field_format, frame, offset, value)
+        frame[-1] = rng.randrange(256)
+        frames.append(bytes(frame))
+
+    expected, result = format_both(make_packets(frames, rng))
+    assert len(expected) == 300
+    assert result == expected
+
+
+def test_unsupported_field_format():
+    with pytest.raises(ValueError):
+        make_profile("Wide", "flow", [(25, "q"), (33, "I"), (37, "B")])
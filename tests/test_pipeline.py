@@ -0,0 +1,91 @@
+"""
+Drop policies and error handling of the pipeline stages
+"""
+
+import threading
+
+import pytest
+
+from pipeline import Stage
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+
+def run_stage(drop_policy, items, maxsize=3):
+    """
+    Queue items in a stage before it is started, and get the items it
+    processes and the stage
+    """
+    processed = []
+    stage = Stage("test", processed.append, maxsize, drop_policy)
+    for item in items:
+        stage.put(item)
+    stage.start()
+    stage.stop()
+    return processed, stage
+
+
+@pytest.mark.parametrize(
+    "drop_policy, expected",
+    [
+        ("drop-newest", [0, 1, 2]),
+        ("drop-oldest", [2, 3, 4]),
+        # Nothing takes items out before the stage is started
+        ("block", [2, 3, 4]),
+    ],
+)
+def test_full_queue(drop_policy, expected):
+    processed, stage = run_stage(drop_policy, range(5))
+    assert processed == expected
+    stats = stage.stats()
+    assert stats["received"] == 5
+    assert stats["dropped"] == 2
+    assert stats["max_depth"] == 3
+
+
+def test_block_waits_for_a_started_stage():
+    release = threading.Event()
+    processed = []
+
+    def handler(item):
+        release.wait()
+        processed.append(item)
+
+    stage = Stage("slow", handler, 2, "block")
+    stage.start()
+    producer = threading.Thread(
+        target=lambda: [stage.put(item) for item in range(10)]
+    )
+    producer.start()
+    producer.join(0.2)
+    assert producer.is_alive()
+    release.set()
+    producer.join()
+    stage.stop()
+    assert processed == list(range(10))
+    assert stage.stats()["dropped"] == 0
+
+
+def test_results_and_errors():
+    errors = []
+    results = []
+
+    def handler(item):
+        if item == 2:
+            raise ValueError(item)
+        if item % 2:
+            return item * 10
+        return None
+
+    first = Stage("first", handler, on_error=errors.append)
+    second = first.connect(Stage("second", results.append))
+    second.start()
+    first.start()
+    for item in range(5):
+        first.put(item)
+    first.stop()
+    second.stop()
+    assert results == [10, 30]
+    assert [str(e) for e in errors] == ["2"]
+    assert first.stats()["errors"] == 1
+    assert first.stats()["processed"] == 5
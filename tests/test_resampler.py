@@ -0,0 +1,65 @@
+"""
+Compare the streaming resampler with resampling a whole file at once
+"""
+
+import numpy as np
+import pandas as pd
+
+from resampler import StreamingResampler, resample_frame
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+
+def resample_whole(series):
+    """
+    Resample like analyze_data did before the streaming resampler
+    """
+    return (
+        series.resample("1min").mean().interpolate().resample("10min").mean()
+    )
+
+
+def test_last_reading_of_interval_is_kept():
+    # 00:09 is in the last step of its interval and is needed for 00:10
+    df = pd.DataFrame(
+        {"P": [1.0, 2.0, 4.0]},
+        index=pd.to_datetime(
+            ["2021-05-30 00:05", "2021-05-30 00:09", "2021-05-30 00:15"]
+        ),
+    )
+    result = resample_frame(df, ["P"])
+    expected = resample_whole(df["P"])
+    assert np.allclose(result["P"], expected)
+
+
+def test_chunks_match_whole_file():
+    rng = np.random.default_rng(0)
+    count = 400
+    times = pd.Timestamp("2021-05-30") + pd.to_timedelta(
+        np.sort(rng.uniform(0, 2 * 86400, count)), unit="s"
+    )
+    df = pd.DataFrame(
+        {"P": rng.normal(3, 1, count), "F": rng.normal(5, 1, count)},
+        index=times,
+    )
+    df.loc[df.index[rng.random(count) < 0.4], "F"] = np.nan
+    df.loc[df.index[:50], "P"] = np.nan
+
+    resampler = StreamingResampler(["P", "F"])
+    parts = []
+    start = 0
+    for end in sorted(rng.choice(count, 5, replace=False)) + [count]:
+        parts.append(resampler.feed(df.iloc[start:end]))
+        start = end
+    parts.append(resampler.finish())
+    result = pd.concat([part for part in parts if not part.empty])
+
+    assert result.index.is_unique
+    for column in ("P", "F"):
+        expected = resample_whole(df[column])
+        assert len(result) == len(expected)
+        assert np.allclose(
+            result[column].reindex(expected.index),
+            expected,
+            equal_nan=True,
+        )
@@ -0,0 +1,100 @@
+"""
+Persist and drain the upload spool with a stand-in MQTT client
+"""
+
+import threading
+import time
+
+import pytest
+
+from upload_spool import UploadSpool
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+
+class Client:
+    """
+    MQTT client recording the published payloads, failing the first
+    failures calls
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.published = []
+        self.lock = threading.Lock()
+
+    def publish(self, topic, payload, qos):
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("offline")
+            self.published.append(payload)
+
+    def payloads(self):
+        with self.lock:
+            return list(self.published)
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_resume_after_restart(tmp_path):
+    path = str(tmp_path / "spool.db")
+    spool = UploadSpool(path)
+    for i in range(5):
+        spool.publish("topic", "m%d" % i)
+    spool.ack(spool.pending(2)[-1][0])
+    spool.stop()
+
+    spool = UploadSpool(path)
+    assert spool.depth() == 3
+    assert [row[2] for row in spool.pending(10)] == ["m2", "m3", "m4"]
+    spool.stop()
+
+
+def test_live_messages_ahead_of_backlog(tmp_path):
+    spool = UploadSpool(str(tmp_path / "spool.db"), drain_rate=20)
+    backlog = ["backlog %d" % i for i in range(20)]
+    for payload in backlog:
+        spool.publish("topic", payload)
+    client = Client()
+    spool.start_draining(client)
+    try:
+        wait_for(lambda: client.payloads())
+        spool.publish("topic", "live")
+        wait_for(lambda: "live" in client.payloads())
+        # The backlog takes a second at 20 messages per second
+        assert client.payloads()[-1] != backlog[-1]
+        wait_for(lambda: len(client.payloads()) == 21)
+    finally:
+        spool.stop()
+    published = client.payloads()
+    assert [p for p in published if p != "live"] == backlog
+    assert published.index("live") < 15
+
+
+def test_retry_while_offline(tmp_path):
+    errors = []
+    spool = UploadSpool(
+        str(tmp_path / "spool.db"), drain_rate=100, on_error=errors.append
+    )
+    client = Client(failures=1)
+    spool.start_draining(client)
+    try:
+        for i in range(5):
+            spool.publish("topic", "m%d" % i)
+        wait_for(lambda: len(client.payloads()) == 5)
+        assert spool.depth() == 0
+    finally:
+        spool.stop()
+    assert client.payloads() == ["m%d" % i for i in range(5)]
+    assert len(errors) == 1
+
+
+def test_drain_rate_must_be_positive():
+    with pytest.raises(ValueError):
+        UploadSpool(":memory:", drain_rate=0)
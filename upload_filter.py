@@ -0,0 +1,114 @@
+"""
+Deadband filtering of cloud uploads
+"""
+
+import array
+import time
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+# Upload fields compared with the last published reading of a device
+FILTERED_FIELDS = {
+    "pressure": ("min_pressure", "max_pressure", "inst_pressure"),
+    "flow": ("flow_inst", "flow_max_month"),
+}
+
+# Volume differences, in litres, and the volume in m3 they are taken of
+DIFF_FIELDS = {
+    "flow": (
+        ("flow_inst_diff", "flow_inst"),
+        ("flow_max_month_diff", "flow_max_month"),
+    ),
+}
+
+
+class DeadbandFilter:
+    """
+    Only let a reading through when one of its values has moved more than
+    the deadband of its sensor type since the last reading published for
+    the device, or heartbeat seconds have passed since then
+
+    The last published values and times of all devices of a sensor type
+    are kept in arrays of doubles, with a dictionary from device to row, so
+    the state stays small for thousands of meters. The volume differences of
+    a published flow reading are changed to be since the last published
+    reading, so no consumption is lost with the readings left out.
+    """
+
+    def __init__(self, deadbands, heartbeat=900.0, clock=time.monotonic):
+        self.deadbands = deadbands
+        self.heartbeat = heartbeat
+        self.clock = clock
+
+        # Counters per sensor type
+        self.published = {}
+        self.suppressed = {}
+        self.heartbeats = {}
+
+        # Sensor type to ({device: row}, values, publish times)
+        self._state = {}
+
+    def check(self, sensor_type, device_name, data):
+        """
+        Check if the upload data of a reading should be published, and
+        remember its values if so
+        """
+        fields = FILTERED_FIELDS.get(sensor_type)
+        if fields is None:
+            return True
+        state = self._state.get(sensor_type)
+        if state is None:
+            state = self._state[sensor_type] = (
+                {},
+                array.array("d"),
+                array.array("d"),
+            )
+        rows, values, times = state
+        now = self.clock()
+        width = len(fields)
+
+        row = rows.get(device_name)
+        if row is None:
+            rows[device_name] = len(times)
+            values.extend(data[field] for field in fields)
+            times.append(now)
+            self._count(self.published, sensor_type)
+            return True
+
+        start = row * width
+        deadband = self.deadbands.get(sensor_type, 0.0)
+        for i, field in enumerate(fields):
+            if abs(data[field] - values[start + i]) > deadband:
+                break
+        else:
+            if now - times[row] < self.heartbeat:
+                self._count(self.suppressed, sensor_type)
+                return False
+            self._count(self.heartbeats, sensor_type)
+
+        for diff_field, field in DIFF_FIELDS.get(sensor_type, ()):
+            data[diff_field] = int(1000 * data[field]) - int(
+                1000 * values[start + fields.index(field)]
+            )
+        for i, field in enumerate(fields):
+            values[start + i] = data[field]
+        times[row] = now
+        self._count(self.published, sensor_type)
+        return True
+
+    def stats(self):
+        """
+        Get the counters of the filter, per sensor type
+        """
+        return {
+            sensor_type: {
+                "devices": len(self._state[sensor_type][0]),
+                "published": self.published.get(sensor_type, 0),
+                "suppressed": self.suppressed.get(sensor_type, 0),
+                "heartbeats": self.heartbeats.get(sensor_type, 0),
+            }
+            for sensor_type in self._state
+        }
+
+    def _count(self, counters, sensor_type):
+        counters[sensor_type] = counters.get(sensor_type, 0) + 1
@@ -0,0 +1,204 @@
+"""
+Store-and-forward queue for cloud uploads, kept on local disk
+"""
+
+import sqlite3
+import threading
+import time
+
+__author__ = "Christofer Gilje Skjaeveland"
+
+
+class UploadSpool:
+    """
+    Append-only queue of MQTT messages in a SQLite database in WAL mode
+
+    publish() has the same signature as AWSIoTMQTTClient.publish, so the
+    spool can stand in for the client. A drain thread publishes the spooled
+    messages, and a message is only removed once the client has
+    acknowledged it.
+
+    Messages spooled while the client was offline, or before a restart, are
+    the backlog. It is published in order at most drain_rate per second, so
+    catching up does not flood the connection, and the id of its last
+    acknowledged message is kept in the database, so draining resumes where
+    it stopped after a restart. Messages spooled while online are published
+    at once, ahead of the backlog, so live readings do not wait for it.
+    Publish errors are passed to on_error.
+    """
+
+    def __init__(self, path, drain_rate=20.0, batch_size=100, on_error=None):
+        if not drain_rate > 0:
+            raise ValueError("drain_rate must be positive")
+        self.drain_rate = drain_rate
+        self.batch_size = batch_size
+        self.on_error = on_error
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._appended = threading.Event()
+        self._thread = None
+
+        self._db = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT, payload BLOB)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cursor ("
+            "id INTEGER PRIMARY KEY CHECK (id = 0), acked INTEGER)"
+        )
+        self._db.execute(
+            "INSERT OR IGNORE INTO cursor (id, acked) VALUES (0, 0)"
+        )
+        self.acked = self._db.execute(
+            "SELECT acked FROM cursor WHERE id = 0"
+        ).fetchone()[0]
+
+    def publish(self, topic, payload, qos=1):
+        """
+        Append a message to the spool
+        """
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO spool (topic, payload) VALUES (?, ?)",
+                (topic, payload),
+            )
+        self._appended.set()
+        return True
+
+    def pending(self, limit, after=None):
+        """
+        Get up to limit messages that are not acknowledged, oldest first,
+        only those with an id above after if given
+        """
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, topic, payload FROM spool WHERE id > ? "
+                "ORDER BY id LIMIT ?",
+                (self.acked if after is None else after, limit),
+            ).fetchall()
+
+    def ack(self, row_id):
+        """
+        Move the resume cursor past the message with id row_id
+        """
+        with self._lock:
+            self._db.execute(
+                "UPDATE cursor SET acked = ? WHERE id = 0", (row_id,)
+            )
+            self.acked = row_id
+
+    def remove(self, row_id):
+        """
+        Remove a message published out of order, without moving the resume
+        cursor
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM spool WHERE id = ?", (row_id,))
+
+    def truncate(self):
+        """
+        Remove the acknowledged messages
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM spool WHERE id <= ?", (self.acked,))
+
+    def last_id(self):
+        """
+        Get the id of the last spooled message
+        """
+        with self._lock:
+            return self._db.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM spool"
+            ).fetchone()[0]
+
+    def depth(self):
+        """
+        Get the number of messages waiting to be published
+        """
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM spool WHERE id > ?", (self.acked,)
+            ).fetchone()[0]
+
+    def start_draining(self, client):
+        """
+        Publish the spooled messages with client from a background thread
+        """
+        self._thread = threading.Thread(
+            target=self._drain, args=(client,), name="spool", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._appended.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._db.close()
+
+    def _drain(self, client):
+        interval = 1.0 / self.drain_rate
+        backoff = 1
+        # Messages up to backlog_end are the backlog
+        backlog_end = self.last_id()
+        offline = False
+        next_backlog = time.monotonic()
+        while not self._stop.is_set():
+            self._appended.clear()
+            if not offline:
+                # Live messages first, all at once
+                rows = self.pending(self.batch_size, backlog_end)
+                for row_id, topic, payload in rows:
+                    if not self._publish(client, topic, payload):
+                        offline = True
+                        break
+                    self.remove(row_id)
+                if offline:
+                    next_backlog = time.monotonic() + backoff
+                    backoff = min(2 * backoff, 32)
+                if rows:
+                    continue
+
+            # Then one message of the backlog, in order, or the oldest
+            # message while offline to find out when the client is back
+            rows = self.pending(1)
+            if not rows:
+                self._appended.wait(1.0)
+                continue
+            wait = next_backlog - time.monotonic()
+            if wait > 0:
+                # A live message ends the wait while online
+                (self._stop if offline else self._appended).wait(wait)
+                continue
+            row_id, topic, payload = rows[0]
+            if not self._publish(client, topic, payload):
+                offline = True
+                next_backlog = time.monotonic() + backoff
+                backoff = min(2 * backoff, 32)
+                continue
+            if offline:
+                # Back online, everything spooled until now is backlog
+                offline = False
+                backlog_end = self.last_id()
+            backoff = 1
+            self.ack(row_id)
+            if row_id % self.batch_size == 0 or row_id >= backlog_end:
+                self.truncate()
+            next_backlog = time.monotonic() + interval
+
+    def _publish(self, client, topic, payload):
+        """
+        Publish a message, and pass the error to on_error if it fails
+        """
+        try:
+            client.publish(topic, payload, 1)
+        except Exception as e:
+            if self.on_error is not None:
+                self.on_error(e)
+            return False
+        return True